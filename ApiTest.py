@@ -1,5 +1,6 @@
 __author__ = 'dsmirnov@wildapricot.com'
 
+import itertools
 import urllib.parse
 import json
 
@@ -7,12 +8,8 @@ from waapi import WildApricotClient
 from config import wild_apricot_api_key
 
 def get_10_active_members():
-    params = {'$filter': 'member eq true',
-              '$top': '2',
-              '$async': 'false'}
-    request_url = contactsUrl + '?' + urllib.parse.urlencode(params)
-    print(request_url)
-    return api.request(request_url).Contacts
+    params = {'$filter': 'member eq true'}
+    return list(itertools.islice(api.iter_collection(contactsUrl, params, page_size=10, collection_key='Contacts'), 10))
 
 def get_member_by_email(email):
     params = {'$filter': f'member eq true AND Email eq {email}',
@@ -39,29 +36,37 @@ def create_contact(email, name):
     data = {
         'Email': email,
         'FirstName': name}
-    return api.request(contactsUrl, api_request_object=data, method='POST')
+    return api.request(contactsUrl, post_payload=data, method='POST')
 
 
-def archive_contact(contact_id):
-    data = {
+def archive_payload(contact_id):
+    return {
         'Id': contact_id,
         'FieldValues': [
             {
                 'FieldName': 'Archived',
                 'Value': 'true'}]
     }
-    return api.request(contactsUrl + str(contact_id), api_request_object=data, method='PUT')
+
+
+def archive_contact(contact_id):
+    return api.request(contactsUrl + str(contact_id), post_payload=archive_payload(contact_id), method='PUT')
+
+
+def archive_contacts(contact_ids, max_concurrency=4):
+    """archive many contacts concurrently; returns waapi.BulkResult list in order, failed items have .error set"""
+    requests = [(contactsUrl + str(contact_id), archive_payload(contact_id), 'PUT') for contact_id in contact_ids]
+    return api.bulk(requests, max_concurrency=max_concurrency)
 
 if __name__ == '__main__':
-    api = WildApricotClient(api_key=wild_apricot_api_key)
+    api = WildApricotClient(api_key=wild_apricot_api_key, resource_cache='wa_resources.json')
     api.authenticate_with_apikey()
     # api.authenticate_with_contact_credentials("ADMINISTRATOR_USERNAME", "ADMINISTRATOR_PASSWORD")
-    accounts = api.request("/v2/accounts")
-    account = accounts[0]
+    account = api.get_account()
 
     print(account.PrimaryDomainName)
 
-    contactsUrl = next(res for res in account.Resources if res.Name == 'Contacts').Url
+    contactsUrl = api.contacts_url
 
     # get top 10 active members and print their details
     contacts = get_10_active_members()
@@ -0,0 +1,82 @@
+"""
+Benchmark of converting and serializing Wild Apricot contacts, on a synthetic payload shaped like the
+response of the Contacts resource (a few top level attributes and FieldValues, some holding
+{Id, Label} objects or lists of them).
+
+Compares the old json round trip (dump indented, parse back) with APIObject.to_plain, and the stdlib
+encoder with orjson for request payloads (orjson is skipped when it is not installed).
+
+Usage:
+    python bench_waapi.py --contacts 2000 --fields 40 --runs 3
+"""
+
+import argparse
+import json
+import timeit
+
+import waapi
+
+
+def make_contacts(count, fields):
+    """raw decoded json of `count` contacts with `fields` field values each"""
+    contacts = []
+    for contact_id in range(count):
+        field_values = []
+        for number in range(fields):
+            if number % 10 == 0:
+                value = [{"Id": number, "Label": f"Certification {number}"}]
+            elif number % 5 == 0:
+                value = {"Id": number, "Label": "Active"}
+            elif number % 7 == 0:
+                value = number % 2 == 0
+            else:
+                value = f"value {contact_id} {number}"
+            field_values.append({"FieldName": f"Field {number}", "SystemCode": f"custom-{number}", "Value": value})
+        contacts.append({
+            "Id": contact_id,
+            "Url": f"https://api.wildapricot.org/v2.2/accounts/1/Contacts/{contact_id}",
+            "FirstName": "First",
+            "LastName": f"Last{contact_id}",
+            "Email": f"member{contact_id}@example.com",
+            "DisplayName": f"Last{contact_id}, First",
+            "MembershipEnabled": True,
+            "Status": "Active",
+            "FieldValues": field_values,
+        })
+    return contacts
+
+
+def round_trip(obj):
+    """what APIObject._json_cleans did before to_plain"""
+    return json.loads(obj._jsons_massive_dump())
+
+
+def best(function, runs):
+    return min(timeit.repeat(function, number=1, repeat=runs))
+
+
+parser = argparse.ArgumentParser(description="Benchmark APIObject conversion and payload serialization.")
+parser.add_argument("--contacts", default=2000, type=int, help="Number of contacts in the payload.")
+parser.add_argument("--fields", default=40, type=int, help="Number of field values per contact.")
+parser.add_argument("--runs", default=3, type=int, help="Repetitions, the best one is reported.")
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    raw = json.dumps(make_contacts(args.contacts, args.fields))
+    contacts = waapi.APIObject({"Contacts": json.loads(raw)}).Contacts
+    for contact in contacts:  # resolve lazily wrapped attributes outside of the timings
+        contact.FieldValues
+    assert all(round_trip(contact) == contact.to_plain() for contact in contacts)
+
+    print(f"{args.contacts} contacts with {args.fields} fields, {len(raw) / 1e6:.1f} MB of json, "
+          f"best of {args.runs} runs")
+    print(f"  json round trip         {best(lambda: [round_trip(c) for c in contacts], args.runs):.3f}s")
+    print(f"  to_plain                {best(lambda: [c.to_plain() for c in contacts], args.runs):.3f}s")
+    payload = {"Contacts": contacts}
+    stdlib = best(lambda: json.dumps(payload, cls=waapi._APIObjectEncoder).encode(), args.runs)
+    print(f"  payload dumps, stdlib   {stdlib:.3f}s")
+    if waapi.orjson is not None:
+        print(f"  payload dumps, orjson   {best(lambda: waapi._json_dumps(payload), args.runs):.3f}s")
+    else:
+        print("  payload dumps, orjson   skipped, pip install orjson")
@@ -0,0 +1,123 @@
+"""
+Local SQLite mirror of Wild Apricot contacts, so lookups by Id, email or Jericho card number are served
+from disk instead of a filtered API call each.
+
+Example:
+    from waapi import WildApricotClient
+    from contact_store import ContactStore
+
+    api = WildApricotClient(api_key=wild_apricot_api_key)
+    api.authenticate_with_apikey()
+    store = ContactStore(api)
+    store.refresh() # first run downloads every contact, later runs only what changed since
+    contact = store.get_by_email('someone@example.com')
+"""
+
+import datetime
+import json
+import sqlite3
+
+from waapi import APIObject
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS contacts (
+    id INTEGER PRIMARY KEY,
+    email TEXT COLLATE NOCASE,
+    card_number TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS contacts_email ON contacts (email);
+CREATE INDEX IF NOT EXISTS contacts_card_number ON contacts (card_number);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+class ContactStore:
+    card_number_field = 'Jericho Card Number'
+
+    def __init__(self, api, filename='wa_contacts.sqlite', contacts_url=None):
+        """
+        api -- authenticated WildApricotClient, used to refresh the mirror and for lookups that miss it
+        filename -- SQLite database file
+        contacts_url -- Contacts resource url, default: looked up from the api account
+        """
+        self.api = api
+        self.contacts_url = contacts_url or api.contacts_url
+        self.db = sqlite3.connect(filename)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def refresh(self, overlap=datetime.timedelta(minutes=1)):
+        """
+        Bring the mirror up to date: everything on the first run, afterwards only contacts created or
+        updated since the previous refresh. Returns the number of contacts written.
+        Contacts deleted in Wild Apricot are not noticed; remove the database file to rebuild it.
+        """
+        started = datetime.datetime.now(datetime.timezone.utc)
+        since = self._get_meta('refreshed_at')
+        params = {}
+        if since is not None:
+            # becoming a member or changing level does not touch the profile dates
+            params['$filter'] = (f"'Profile last updated' ge {since} OR 'Creation date' ge {since} OR "
+                                 f"'Member since' ge {since} OR 'Level last changed' ge {since}")
+        count = self.upsert(self.api.submit_query(self.contacts_url, params, collection_key='Contacts'))
+        self._set_meta('refreshed_at', (started - overlap).isoformat())
+        return count
+
+    def upsert(self, contacts):
+        count = 0
+        with self.db:
+            for contact in contacts:
+                self.db.execute("INSERT OR REPLACE INTO contacts (id, email, card_number, data) VALUES (?, ?, ?, ?)",
+                                (contact.Id, getattr(contact, 'Email', None), self._card_number(contact),
+                                 json.dumps(contact.to_plain())))
+                count += 1
+        return count
+
+    def get_by_id(self, contact_id, check=None):
+        return self._lookup("id = ?", contact_id, f"Id eq {contact_id}", check)
+
+    def get_by_email(self, email, check=None):
+        return self._lookup("email = ?", email, f"Email eq {email}", check)
+
+    def get_by_card_number(self, card_number, check=None):
+        return self._lookup("card_number = ?", str(card_number), f"'{self.card_number_field}' eq {card_number}",
+                            check)
+
+    def _lookup(self, condition, value, api_filter, check=None):
+        """
+        serve from the mirror, else ask the api and remember the answer; None if the contact does not exist.
+        check -- optional predicate, e.g. is a member: a mirrored contact failing it may be out of date,
+                 so it is fetched from the api again
+        """
+        row = self.db.execute(f"SELECT data FROM contacts WHERE {condition}", (value,)).fetchone()
+        if row is not None:
+            contact = APIObject(json.loads(row[0]))
+            if check is None or check(contact):
+                return contact
+        matches = self.api.iter_collection(self.contacts_url, {'$filter': api_filter}, page_size=1,
+                                           collection_key='Contacts')
+        contact = next(matches, None)
+        if contact is not None:
+            self.upsert([contact])
+        return contact
+
+    def _card_number(self, contact):
+        try:
+            card_number = contact[self.card_number_field]
+        except (KeyError, ValueError):
+            return None
+        return None if card_number is None else str(card_number)
+
+    def _get_meta(self, key):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def _set_meta(self, key, value):
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
@@ -1,40 +1,285 @@
-import pandas as pd
-from functools import reduce
+"""
+Find contacts to archive in Wild Apricot: everyone who is Lapsed or was never active, and either is not
+subscribed to emails or did not engage with any of the given newsletters. See README.md for the exports.
 
-# load data
-# UPDATE the file names to read from
-contacts = pd.read_csv("../2024-07-30 Contacts UBC Sailing Club.csv")
-newsletters = [pd.read_excel("../2024-07-30 Email details UBC Sailing Club.xls")]
+Usage:
+    python purgeContacts.py "2024-07-30 Contacts UBC Sailing Club.csv" \
+        --newsletters "2024-07-30 Email details UBC Sailing Club.xls" \
+        --criterion clicked --output "2024-07-30 Post-Archival Contacts UBC Sailing Club.csv"
 
-# find members that can potentially be dropped (everyone who is Lapsed or was never active)
-dropCandidates =  set(contacts.loc[(contacts["Membership status"] == "Lapsed") | contacts["Membership status"].isnull(), "User ID"])
+    # or straight from the API, archiving right away (a rollback file is written first)
+    python purgeContacts.py --from_api --email_ids 12345678 12345679 --criterion clicked
+"""
 
-# always drop candidates that are not subscribed to newsletter
-toRemove = set()
+import argparse
+import datetime
+import glob
+import hashlib
+import os
 
-nonSubscribers = set(contacts.loc[contacts["Subscribed to emails"] == "no", "User ID"])
-toRemove |= nonSubscribers & dropCandidates
+import pandas as pd # pip install pandas (and pyarrow for --cache_dir)
 
-# # drop candidates that did not open any of the latest newsletters
-# nonReaders = []
-# for df in newsletters:
-#     nonReaders.append(set(df.loc[df["Opened"] == "No", "User ID"]))
-# notReadAny = reduce(lambda a, b: a & b, nonReaders)
+CONTACT_COLUMNS = ["User ID", "Membership status", "Subscribed to emails"]
+# newsletter log column telling whether a contact engaged, per criterion
+NEWSLETTER_COLUMNS = {"opened": "Opened", "clicked": "Clicked"}
 
-# drop candidates that did not click any event in the latest newsletters
-non_clickers = []
-for newsletter in newsletters:
-    non_clickers.append(set(newsletter.loc[newsletter["Clicked"] == "No", "User ID"]))
-not_click_any = reduce(lambda a, b: a & b, non_clickers)
 
-toRemove |= not_click_any & dropCandidates
+def read_export(filename, columns):
+    """Read only the needed columns of a csv or excel export from Wild Apricot."""
+    dtype = {column: "category" for column in columns if column != "User ID"}
+    if filename.endswith((".xls", ".xlsx")):
+        try:
+            # much faster than the default readers: pip install python-calamine (pandas >= 2.2)
+            frame = pd.read_excel(filename, usecols=columns, engine="calamine")
+        except (ImportError, ValueError):
+            frame = pd.read_excel(filename, usecols=columns)
+        return frame.astype(dtype)
+    return pd.read_csv(filename, usecols=columns, dtype=dtype)
 
-# export user ids that will be archived
-print(f"{len(toRemove)} members will be archived. See yaaa")
 
-rollForward = contacts.loc[contacts["User ID"].isin(toRemove), ["User ID"]]
-rollForward["Archived"] = "yes"
+def file_hash(filename):
+    digest = hashlib.sha256()
+    with open(filename, "rb") as export:
+        for block in iter(lambda: export.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
 
-# UPDATE the file name to export the results to 
-rollForward.to_csv("../2024-07-30 Post-Archival Contacts UBC Sailing Club.csv", index=False,
-          header=True)
+
+def cached_export(filename, columns, cache_dir, cached_columns=None):
+    """
+    Read columns of an export through a Parquet copy in cache_dir, keyed by the hash of the export's content,
+    so every later run skips parsing the csv/excel file and reads only the requested columns.
+    """
+    path = os.path.join(cache_dir, file_hash(filename) + ".parquet")
+    if not os.path.exists(path):
+        os.makedirs(cache_dir, exist_ok=True)
+        read_export(filename, cached_columns or columns).to_parquet(path + ".tmp", index=False)
+        os.replace(path + ".tmp", path)
+    return pd.read_parquet(path, columns=columns)
+
+
+def ingest_newsletter(filename, cache_dir):
+    """
+    Add a newsletter log to the dataset in cache_dir/newsletters, one Parquet file per newsletter holding
+    both engagement columns and a Newsletter key, so logs accumulate across seasons; returns the key.
+    """
+    key = file_hash(filename)[:16]
+    directory = os.path.join(cache_dir, "newsletters")
+    path = os.path.join(directory, key + ".parquet")
+    if not os.path.exists(path):
+        os.makedirs(directory, exist_ok=True)
+        log = read_export(filename, ["User ID", *NEWSLETTER_COLUMNS.values()]).assign(Newsletter=key)
+        log.to_parquet(path + ".tmp", index=False)
+        os.replace(path + ".tmp", path)
+    return key
+
+
+def newsletter_history(cache_dir, columns=None, last=None):
+    """
+    All ingested newsletter logs as one frame with a Newsletter column, optionally only the `last` most
+    recently ingested ones, e.g. to count how many of a season's newsletters each contact clicked:
+        newsletter_history(cache_dir).query("Clicked == 'Yes'").groupby("User ID")["Newsletter"].nunique()
+    """
+    paths = sorted(glob.glob(os.path.join(cache_dir, "newsletters", "*.parquet")), key=os.path.getmtime)
+    if last is not None:
+        paths = paths[-last:] if last else []
+    if not paths:
+        return pd.DataFrame(columns=["User ID", *NEWSLETTER_COLUMNS.values(), "Newsletter"])
+    columns = None if columns is None else ["User ID", *columns, "Newsletter"]
+    return pd.concat([pd.read_parquet(path, columns=columns) for path in paths], ignore_index=True)
+
+
+def load_contacts(filenames, cache_dir=None):
+    """Contacts of all exports, the last export wins for contacts present in several."""
+    if cache_dir is None:
+        frames = [read_export(filename, CONTACT_COLUMNS) for filename in filenames]
+    else:
+        frames = [cached_export(filename, CONTACT_COLUMNS, cache_dir) for filename in filenames]
+    contacts = pd.concat(frames, ignore_index=True)
+    return contacts.drop_duplicates("User ID", keep="last")
+
+
+def load_newsletters(filenames, criterion="clicked", cache_dir=None, history=0):
+    """
+    One frame per newsletter. With cache_dir the logs are ingested into the newsletter dataset, and
+    the `history` most recently ingested newsletters from earlier runs are included as well.
+    """
+    column = NEWSLETTER_COLUMNS[criterion]
+    if cache_dir is None:
+        return [read_export(filename, ["User ID", column]) for filename in filenames]
+    keys = [ingest_newsletter(filename, cache_dir) for filename in filenames]
+    logs = newsletter_history(cache_dir, [column])
+    recent = [key for key in logs["Newsletter"].unique() if key not in keys][-history:] if history else []
+    return [logs.loc[logs["Newsletter"].eq(key), ["User ID", column]] for key in [*recent, *keys]]
+
+
+def drop_candidates(contacts, newsletters=(), criterion="clicked"):
+    """
+    User IDs of contacts to archive.
+
+    Lapsed or never active contacts are dropped if they are not subscribed to emails, or if they did not
+    open/click (criterion) any of the newsletters, i.e. are logged with "No" in every one of them.
+    """
+    status = contacts["Membership status"]
+    lapsed = status.eq("Lapsed") | status.isna()
+    to_remove = contacts["Subscribed to emails"].eq("no")
+
+    if newsletters:
+        column = NEWSLETTER_COLUMNS[criterion]
+        logs = pd.concat([newsletter[["User ID", column]].assign(newsletter=number)
+                          for number, newsletter in enumerate(newsletters)], ignore_index=True)
+        ignored = logs.loc[logs[column].eq("No")].groupby("User ID")["newsletter"].nunique()
+        ignored_all = ignored.index[ignored.eq(len(newsletters))]
+        to_remove |= contacts["User ID"].isin(ignored_all)
+
+    return contacts.loc[lapsed & to_remove, "User ID"]
+
+
+def write_import_file(user_ids, filename, archived="yes"):
+    """Write a contacts import file setting Archived for the given User IDs."""
+    pd.DataFrame({"User ID": user_ids, "Archived": archived}).to_csv(filename, index=False, header=True)
+
+
+def field_label(value):
+    """Text of a field value, which the API gives either as plain value or as {Id, Label/Value} object."""
+    for attribute in ("Label", "Value"):
+        if hasattr(value, attribute):
+            return getattr(value, attribute)
+    return value
+
+
+def fetch_contacts(api):
+    """Non-archived contacts from the API, with the same columns as a contacts export."""
+    params = {"$filter": "Archived eq false",
+              "$select": ",".join(f"'{column}'" for column in ["Membership status", "Subscribed to emails"])}
+    rows = []
+    for contact in api.submit_query(api.contacts_url, params, collection_key="Contacts"):
+        fields = {field.FieldName: field.Value for field in contact.FieldValues}
+        status = field_label(fields.get("Membership status")) or getattr(contact, "Status", None)
+        # only an explicit "not subscribed" counts, a missing field must never get a contact archived
+        subscribed = fields.get("Subscribed to emails", True)
+        rows.append((contact.Id, status, "no" if subscribed is False else "yes"))
+    return pd.DataFrame(rows, columns=CONTACT_COLUMNS).astype({"Membership status": "category",
+                                                               "Subscribed to emails": "category"})
+
+
+def fetch_newsletter(api, email_id, criterion="clicked"):
+    """
+    Recipients of one sent email, with the same columns as an email log export.
+    Uses the SentEmailRecipients resource; a recipient engaged if IsOpened/IsClicked is set.
+    """
+    column = NEWSLETTER_COLUMNS[criterion]
+    flag = "IsOpened" if criterion == "opened" else "IsClicked"
+    account = api.get_account()
+    url = f"{api.api_endpoint}/v2.2/accounts/{account.Id}/SentEmailRecipients"
+    rows = [(recipient.Contact.Id, "Yes" if getattr(recipient, flag, False) else "No")
+            for recipient in api.iter_collection(url, {"emailId": email_id}) if getattr(recipient, "Contact", None)]
+    return pd.DataFrame(rows, columns=["User ID", column])
+
+
+def archive_contacts(api, user_ids, max_concurrency=4, rate_limit=60):
+    """
+    Archive contacts with concurrent PUTs, at most rate_limit per minute; returns the User IDs that failed.
+    """
+    requests = [(api.contacts_url + str(user_id),
+                 {"Id": user_id, "FieldValues": [{"FieldName": "Archived", "Value": "true"}]},
+                 "PUT")
+                for user_id in user_ids]
+    results = api.bulk(requests, max_concurrency=max_concurrency, rate_limit=rate_limit, per=60)
+    return [user_id for user_id, result in zip(user_ids, results) if result.error is not None]
+
+
+parser = argparse.ArgumentParser(description="Compute which Wild Apricot contacts to archive.")
+parser.add_argument("contacts", nargs="*", type=str, help="Contacts export(s), csv or excel.")
+parser.add_argument(
+    "--newsletters",
+    "-n",
+    nargs="*",
+    default=[],
+    type=str,
+    help="Email log export(s) of the latest newsletters, csv or excel.",
+)
+parser.add_argument(
+    "--criterion",
+    "-c",
+    choices=sorted(NEWSLETTER_COLUMNS),
+    default="clicked",
+    help="Drop contacts that did not open or did not click any of the newsletters.",
+)
+parser.add_argument("--output", "-o", default=None, type=str, help="Contacts import file to write.")
+parser.add_argument(
+    "--from_api",
+    action="store_true",
+    help="Read contacts and email logs from the Wild Apricot API and archive the contacts right away.",
+)
+parser.add_argument(
+    "--email_ids",
+    nargs="*",
+    default=[],
+    type=str,
+    help="IDs of the sent newsletters to check engagement with, with --from_api.",
+)
+parser.add_argument(
+    "--rollback",
+    default=None,
+    type=str,
+    help="Import file un-archiving the contacts, written before archiving with --from_api. "
+         "Default: Rollback Contacts <timestamp>.csv",
+)
+parser.add_argument("--dry_run", action="store_true", help="With --from_api, only report what would be archived.")
+parser.add_argument(
+    "--rate_limit",
+    default=60,
+    type=int,
+    help="With --from_api, max archive requests per minute; keep it within the Wild Apricot API limits.",
+)
+parser.add_argument("--workers", default=4, type=int, help="With --from_api, archive requests in flight at once.")
+parser.add_argument(
+    "--cache_dir",
+    default=None,
+    type=str,
+    help="Directory of Parquet copies of the exports; newsletter logs accumulate there across runs.",
+)
+parser.add_argument(
+    "--history",
+    default=0,
+    type=int,
+    help="Also require no engagement with this many previously cached newsletters (needs --cache_dir).",
+)
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    if not args.from_api and (not args.contacts or args.output is None):
+        parser.error("contacts exports and --output are required unless --from_api is given")
+    if args.history and args.cache_dir is None:
+        parser.error("--history needs --cache_dir, where earlier newsletters are kept")
+
+    if args.from_api:
+        from waapi import WildApricotClient
+        from config import wild_apricot_api_key
+
+        api = WildApricotClient(api_key=wild_apricot_api_key)
+        api.authenticate_with_apikey()
+        contacts = fetch_contacts(api)
+        newsletters = [fetch_newsletter(api, email_id, args.criterion) for email_id in args.email_ids]
+    else:
+        contacts = load_contacts(args.contacts, args.cache_dir)
+        newsletters = load_newsletters(args.newsletters, args.criterion, args.cache_dir, args.history)
+    to_remove = drop_candidates(contacts, newsletters, args.criterion)
+
+    # export user ids that will be archived
+    print(f"{len(to_remove)} members will be archived. See yaaa")
+    if args.output is not None:
+        write_import_file(to_remove, args.output)
+
+    if args.from_api and not args.dry_run:
+        rollback = args.rollback or f"Rollback Contacts {datetime.datetime.now():%Y-%m-%d %H%M%S}.csv"
+        write_import_file(to_remove, rollback, archived="no")
+        print(f"To undo, import {rollback} in admin/contacts/import/upload-file/")
+        # the first rate_limit requests go out at once, the rest at rate_limit per minute
+        minutes = max(len(to_remove) - args.rate_limit, 0) / args.rate_limit
+        print(f"Archiving {len(to_remove)} contacts at {args.rate_limit}/minute, about {minutes:.0f} minutes")
+        failed = archive_contacts(api, to_remove.tolist(), args.workers, args.rate_limit)
+        if failed:
+            print(f"{len(failed)} contacts could not be archived: {failed}")
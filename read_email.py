@@ -1,5 +1,6 @@
 import os.path
 import base64
+import time
 from datetime import datetime, timedelta
 from io import BytesIO
 
@@ -119,7 +120,16 @@ class GmailClient:
                 token.write(credentials.to_json())
         return credentials
 
-    def read_emails(self, status='unread', since=None, **kwargs):
+    def read_emails(self, status='unread', since=None, *, format='full', metadata_headers=None,
+                    batch_size=50, **kwargs):
+        """
+        Yield the matching inbox messages as Emails, listing page by page and fetching the
+        messages with batch requests of batch_size (at most 100; Gmail rate limits large
+        batches, 50 is its recommendation).
+
+        format -- 'full', 'metadata' (headers only, much cheaper), 'minimal' or 'raw'
+        metadata_headers -- with format='metadata', only these headers, e.g. ['Subject', 'From']
+        """
         if since is not None:
             timestamp_since = (datetime.now() - since).strftime('%Y/%m/%d')
         else:
@@ -127,10 +137,52 @@ class GmailClient:
         dispatch = {'unread': 'is:unread ', 'read': 'is:read ', 'all': ''}
         query = f"{dispatch[status]}after:{timestamp_since}"
         kwargs.setdefault('q', query)
-        results = self.service.users().messages().list(userId='me', labelIds=['INBOX'], **kwargs).execute()
-        messages = results.get('messages', [])
-        for message in messages[:4]:
-            yield Email(self.service.users().messages().get(userId='me', id=message['id']).execute())
+        kwargs.setdefault('maxResults', 500)
+        get_kwargs = {'format': format}
+        if metadata_headers is not None:
+            get_kwargs['metadataHeaders'] = metadata_headers
+
+        messages = self.service.users().messages()
+        batch_size = min(batch_size, 100)
+        page_token = None
+        while True:
+            results = messages.list(userId='me', labelIds=['INBOX'], pageToken=page_token, **kwargs).execute()
+            ids = [message['id'] for message in results.get('messages', [])]
+            for start in range(0, len(ids), batch_size):
+                yield from self._get_messages(ids[start:start + batch_size], get_kwargs)
+            page_token = results.get('nextPageToken')
+            if page_token is None:
+                return
+
+    def _get_messages(self, ids, get_kwargs, retries=5):
+        """fetch messages with one batch request, in order; rate limited ones are fetched again"""
+        fetched = {}
+        failed = {}
+
+        def callback(request_id, response, exception):
+            if exception is None:
+                fetched[request_id] = response
+            else:
+                failed[request_id] = exception
+
+        pending = ids
+        for attempt in range(retries + 1):
+            batch = self.service.new_batch_http_request(callback=callback)
+            for message_id in pending:
+                batch.add(self.service.users().messages().get(userId='me', id=message_id, **get_kwargs),
+                          request_id=message_id)
+            failed.clear()
+            batch.execute()
+            for message_id, exception in failed.items():
+                if getattr(exception, 'resp', None) is None or exception.resp.status not in (429, 500, 503):
+                    raise exception
+            if not failed:
+                break
+            if attempt == retries:
+                raise next(iter(failed.values()))
+            pending = list(failed)
+            time.sleep(2 ** attempt)
+        return [Email(fetched[message_id]) for message_id in ids]
 
     def mark_as_read(self, message, **kwargs):
         return self.service.users().messages().modify(userId='me', id=message.email['id'], body={'removeLabelIds': ['UNREAD']}, **kwargs).execute()
@@ -138,7 +190,8 @@ class GmailClient:
 if __name__ == '__main__':
     creds_filename = 'gmail_web_client_secret.json'
     mailbox = GmailClient(creds_filename)
-    for message in mailbox.read_emails(since=timedelta(days=2)):
+    for message in mailbox.read_emails(since=timedelta(days=2), format='metadata',
+                                       metadata_headers=['Subject', 'From', 'Date']):
     # for message in mailbox.read_emails(status='all'):
         print(f'Subject: {message.subject}')
         print(f'From: {message.sender}')
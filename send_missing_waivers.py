@@ -1,13 +1,24 @@
+import argparse
+import concurrent.futures
+import datetime
 import requests
 import json
+import os
+import threading
+import time
 
 from config import e_signatures_token as token
 
 ESIG_URL = f'https://esignatures.io/api/contracts%s?token={token}'
+# final contract statuses: a signed contract is a waiver on file, a void one lets
+# the member get a new waiver; any other status (sent, opened, ...) is pending and
+# counts as a waiver already sent
+SIGNED_STATUSES = {'signed'}
+VOID_STATUSES = {'declined', 'withdrawn'}
 # you gotta quit those e-cigs Earl! It's not healthy!
 
 def send_waiver(name, email, *, url=ESIG_URL, headers=None,
-                template_id='965ec98c-3958-4bc6-b131-556918d35649'):
+                template_id='965ec98c-3958-4bc6-b131-556918d35649', session=None):
     """
     Sends a waiver to a signer.
 
@@ -20,6 +31,7 @@ def send_waiver(name, email, *, url=ESIG_URL, headers=None,
         Defaults to {'Content-type': 'application/json'}.
         template_id (str, optional): The ID of the waiver template to use. Defaults
         to the UBC Sailing Club Membership Waiver Form.
+        session (requests.Session, optional): Session to reuse connections from.
 
     Returns:
         dict: The JSON response from the request.
@@ -39,11 +51,11 @@ def send_waiver(name, email, *, url=ESIG_URL, headers=None,
         ]
     }
 
-    response = requests.post(url % '', headers=headers, data=json.dumps(data))
+    response = (session or requests).post(url % '', headers=headers, data=json.dumps(data))
     response.raise_for_status()
     return response.json()
 
-def query_contract(contract_id, *, url=ESIG_URL, headers=None):
+def query_contract(contract_id, *, url=ESIG_URL, headers=None, session=None):
     """
     Queries the status of a contract.
 
@@ -53,6 +65,7 @@ def query_contract(contract_id, *, url=ESIG_URL, headers=None):
         to using esignatures.io; requires config.py file with the secret token.
         headers (dict, optional): Additional headers to include in the request.
         Defaults to {'Content-type': 'application/json'}.
+        session (requests.Session, optional): Session to reuse connections from.
 
     Returns:
         dict: The JSON response from the request.
@@ -62,11 +75,72 @@ def query_contract(contract_id, *, url=ESIG_URL, headers=None):
         headers = {}
     headers.setdefault('Content-type', 'application/json')
 
-    response = requests.get(url % f'/{contract_id}', headers=headers)
+    response = (session or requests).get(url % f'/{contract_id}', headers=headers)
     response.raise_for_status()
     return response.json()
 
-def download_all_waivers(contracts_data, output_dir):
+class RateLimiter:
+    """Spaces out calls from any number of threads to at most `per_second` per second."""
+
+    def __init__(self, per_second):
+        self.interval = 1 / per_second
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        time.sleep(start - now)
+
+
+def make_session(pool_size=8, max_retries=5):
+    """
+    Shared session reusing connections, retrying 429/5xx and connection errors with
+    exponential backoff (and the server's Retry-After).
+    """
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    retry = Retry(total=max_retries, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504],
+                  allowed_methods=['GET'], respect_retry_after_header=True)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def download_waiver(contract_id, output_dir, *, session=None, limiter=None):
+    """
+    Downloads the PDF of one contract to output_dir, streamed to a .part file
+    that is only renamed once complete.
+
+    Returns:
+        str: The path of the PDF.
+
+    """
+    if limiter is not None:
+        limiter.wait()
+    response = query_contract(contract_id, session=session)
+    url = response['data']['contract_pdf_url']
+    timestamp = url.split('/')[-1].split('-utc-')[0]
+    name = response['data']['signers'][0]['name']
+    filename = os.path.join(output_dir, timestamp + ' ' + name + '.pdf')
+
+    if limiter is not None:
+        limiter.wait()
+    with (session or requests).get(url, stream=True) as pdf:
+        pdf.raise_for_status()
+        with open(filename + '.part', 'wb') as file:
+            for chunk in pdf.iter_content(chunk_size=64 * 1024):
+                file.write(chunk)
+    os.replace(filename + '.part', filename)
+    return filename
+
+
+def download_all_waivers(contracts_data, output_dir, *, workers=8, per_second=5, max_retries=5):
     """
     Downloads all waivers from the e-signatures service as PDF.
 
@@ -74,24 +148,222 @@ def download_all_waivers(contracts_data, output_dir):
         contracts_data (string): The contracts data CSV exported from
         the e-signatures website.
         output_dir (string): The directory to save the PDFs to.
+        workers (int, optional): Number of concurrent downloads.
+        per_second (float, optional): Max requests started per second, to stay
+        under the service's rate limit.
+        max_retries (int, optional): Retries of each request on 429/5xx or
+        connection errors, with exponential backoff.
+
+    Returns:
+        dict: Contract ID to error for the downloads that failed.
 
     Notes:
     ------
-    Might get rate-limited and/or blocked if there's too many requests.
+    Downloaded contracts are recorded in a `downloaded.jsonl` manifest in
+    output_dir, so an interrupted run can simply be restarted and skips them.
     This function shouldn't need to be called anymore, as the waivers are
     automatically saved to the Google Drive.
 
     """
-    import urllib.request
     import pandas as pd
     import tqdm
 
-    output_dir += '/' if not output_dir.endswith('/') else ''
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = os.path.join(output_dir, 'downloaded.jsonl')
+    done = set()
+    if os.path.exists(manifest):
+        with open(manifest) as file:
+            done = {json.loads(line)['contract_id'] for line in file if line.strip()}
+
     df = pd.read_csv(contracts_data)
+    contract_ids = [contract_id for contract_id in df['Contract ID'] if contract_id not in done]
+    session = make_session(pool_size=workers, max_retries=max_retries)
+    limiter = RateLimiter(per_second)
+    failed = {}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(download_waiver, contract_id, output_dir, session=session, limiter=limiter):
+                   contract_id for contract_id in contract_ids}
+        for future in tqdm.tqdm(concurrent.futures.as_completed(futures), total=len(futures)):
+            contract_id = futures[future]
+            try:
+                filename = future.result()
+            except (requests.RequestException, KeyError, IndexError, OSError) as error:
+                failed[contract_id] = error
+                continue
+            with open(manifest, 'a') as file:
+                file.write(json.dumps({'contract_id': contract_id, 'filename': filename}) + '\n')
+    return failed
+
+
+def read_jsonl(filename):
+    if not os.path.exists(filename):
+        return []
+    with open(filename) as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def append_jsonl(filename, record):
+    with open(filename, 'a') as file:
+        file.write(json.dumps(record) + '\n')
+        file.flush()
+        os.fsync(file.fileno())
+
+
+def index_contracts(contract_ids, index_file, *, session=None, limiter=None, workers=8):
+    """
+    Maps signer email (lowercase) to the IDs of their signed or pending contracts,
+    i.e. the members that already have a waiver or were already sent one; declined
+    and withdrawn contracts do not count. Contracts are queried concurrently,
+    except those with a final status already in index_file (a jsonl cache of
+    earlier runs); pending contracts are checked again on every run.
+
+    Returns:
+        tuple: (dict: email -> list of signed or pending contract IDs,
+        dict: contract ID -> error for contracts that could not be queried).
+
+    """
+    statuses = {record['contract_id']: (record['status'], record['email']) for record in read_jsonl(index_file)
+                if record.get('status') in SIGNED_STATUSES | VOID_STATUSES}
+    missing = [contract_id for contract_id in contract_ids if contract_id not in statuses]
+
+    def signer(contract_id):
+        if limiter is not None:
+            limiter.wait()
+        data = query_contract(contract_id, session=session)['data']
+        return data['status'], data['signers'][0]['email']
+
+    failed = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(signer, contract_id): contract_id for contract_id in missing}
+        for future in concurrent.futures.as_completed(futures):
+            contract_id = futures[future]
+            try:
+                status, email = future.result()
+            except (requests.RequestException, KeyError, IndexError, TypeError, ValueError) as error:
+                failed[contract_id] = error
+                continue
+            statuses[contract_id] = (status, email)
+            if status in SIGNED_STATUSES | VOID_STATUSES:
+                append_jsonl(index_file, {'contract_id': contract_id, 'email': email, 'status': status})
+
+    by_email = {}
+    for contract_id, (status, email) in statuses.items():
+        if status not in VOID_STATUSES:
+            by_email.setdefault(email.strip().lower(), []).append(contract_id)
+    return by_email, failed
+
+
+def fetch_active_members(api):
+    """
+    Active members from Wild Apricot.
+
+    Returns:
+        dict: email (lowercase) -> display name.
+
+    """
+    params = {'$filter': "Member eq true AND 'Membership status' eq Active"}
+    members = {}
+    for contact in api.submit_query(api.contacts_url, params, collection_key='Contacts'):
+        email = getattr(contact, 'Email', None)
+        if email:
+            members[email.strip().lower()] = contact.DisplayName
+    return members
+
+
+def send_missing_waivers(members, contracts_by_email, ledger_file, *, dry_run=False,
+                         session=None, limiter=None, workers=4):
+    """
+    Sends a waiver to every member that has no contract yet.
+
+    Args:
+        members (dict): email -> name of the members that need a waiver.
+        contracts_by_email (dict): email -> contract IDs of signed or pending waivers.
+        ledger_file (str): jsonl ledger of sent waivers. An email is recorded
+        as 'sending' before the request and 'sent' after it, and any email in
+        the ledger is never sent to again, so a crash mid-request can not cause
+        a double send; 'sending' entries without 'sent' are reported as
+        'unconfirmed' and need a manual check (remove their lines from the
+        ledger to send them a waiver again).
+        dry_run (bool, optional): Only report who would get a waiver.
+
+    Returns:
+        dict: Report with the 'missing', 'sent', 'skipped', 'unconfirmed' and
+        'failed' emails.
+
+    """
+    ledger = {record['email']: record['status'] for record in read_jsonl(ledger_file)}
+    missing = sorted(set(members) - set(contracts_by_email))
+    to_send = [email for email in missing if email not in ledger]
+    report = {'missing': missing, 'sent': [], 'failed': {},
+              'skipped': [email for email in missing if ledger.get(email) == 'sent'],
+              'unconfirmed': [email for email in missing if ledger.get(email) == 'sending']}
+    if dry_run:
+        report['would_send'] = to_send
+        return report
+
+    def send(email):
+        if limiter is not None:
+            limiter.wait()
+        append_jsonl(ledger_file, {'email': email, 'status': 'sending',
+                                   'at': datetime.datetime.now().isoformat()})
+        response = send_waiver(members[email], email, session=session)
+        append_jsonl(ledger_file, {'email': email, 'status': 'sent', 'contract_id': response.get('data', {}).get('contract', {}).get('id'),
+                                   'at': datetime.datetime.now().isoformat()})
+        return email
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(send, email): email for email in to_send}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                report['sent'].append(future.result())
+            except (requests.RequestException, KeyError) as error:
+                report['failed'][futures[future]] = str(error)
+    return report
+
+
+parser = argparse.ArgumentParser(description="Send waivers to active members that have not signed one.")
+parser.add_argument("contracts_data", type=str, help="Contracts data CSV exported from the e-signatures website.")
+parser.add_argument("--dry_run", action="store_true", help="Only report who is missing a waiver.")
+parser.add_argument("--workers", default=4, type=int, help="Concurrent requests to e-signatures.")
+parser.add_argument("--per_second", default=2, type=float, help="Max requests started per second.")
+parser.add_argument("--index_file", default="contracts_index.jsonl", type=str, help="Cache of contract signers.")
+parser.add_argument("--ledger_file", default="sent_waivers.jsonl", type=str, help="Ledger of sent waivers.")
+
+
+if __name__ == '__main__':
+    import pandas as pd
+
+    from waapi import WildApricotClient
+    from config import wild_apricot_api_key
+
+    args = parser.parse_args()
+    api = WildApricotClient(api_key=wild_apricot_api_key)
+    api.authenticate_with_apikey()
+    members = fetch_active_members(api)
+
+    session = make_session(pool_size=args.workers)
+    limiter = RateLimiter(args.per_second)
+    contract_ids = pd.read_csv(args.contracts_data)['Contract ID'].tolist()
+    contracts_by_email, failed_contracts = index_contracts(contract_ids, args.index_file, session=session,
+                                                           limiter=limiter, workers=args.workers)
+    if failed_contracts:
+        print(f"{len(failed_contracts)} contracts could not be queried and count as no waiver:")
+        for contract_id, error in failed_contracts.items():
+            print(f"\t{contract_id}: {error!r}")
 
-    for contract_id in tqdm.tqdm(df['Contract ID']):
-        response = query_contract(contract_id)
-        url = response['data']['contract_pdf_url']
-        timestamp = url.split('/')[-1].split('-utc-')[0]
-        name = response['data']['signers'][0]['name']
-        urllib.request.urlretrieve(url, output_dir + timestamp + ' ' + name + '.pdf')
+    report = send_missing_waivers(members, contracts_by_email, args.ledger_file, dry_run=args.dry_run,
+                                  session=session, limiter=limiter, workers=args.workers)
+    print(f"{len(members)} active members, {len(report['missing'])} without a waiver")
+    if args.dry_run:
+        print(f"would send {len(report['would_send'])}:")
+        for email in report['would_send']:
+            print(f"\t{members[email]} <{email}>")
+    else:
+        print(f"sent {len(report['sent'])}, failed {len(report['failed'])}: {report['failed']}")
+    if report['skipped']:
+        print(f"already in {args.ledger_file}, not resent: {report['skipped']}")
+    if report['unconfirmed']:
+        print(f"send attempted but never confirmed, check by hand and remove from {args.ledger_file} to retry:")
+        for email in report['unconfirmed']:
+            print(f"\t{members[email]} <{email}>")
@@ -9,15 +9,100 @@
 # ///
 
 import argparse
+import concurrent.futures
+import hashlib
+import mimetypes
 import os.path
+import threading
+import time
 from io import BytesIO
 import json
 
+import httplib2
 from google.auth.transport.requests import Request
+from google_auth_httplib2 import AuthorizedHttp
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseUpload, MediaFileUpload
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaIoBaseUpload, MediaFileUpload, MediaUpload
+
+# must be a multiple of 256 KiB; bigger chunks mean fewer round trips per file
+CHUNK_SIZE = 8 * 1024 * 1024
+
+
+class JsonStreamUpload(MediaUpload):
+    """
+    Resumable upload of text produced on the fly, e.g. by json.JSONEncoder().iterencode
+    or a generator of records, so the serialized file is never held in memory as a
+    whole: only about two chunks of it are buffered at a time. The size is unknown
+    until the pieces run out, which the resumable protocol allows.
+    """
+
+    def __init__(self, pieces, mimetype="application/json", chunksize=CHUNK_SIZE):
+        super().__init__()
+        self._pieces = iter(pieces)
+        self._mimetype = mimetype
+        self._chunksize = chunksize
+        # bytes from offset _start on that were produced but not yet acknowledged
+        self._buffer = bytearray()
+        self._start = 0
+        # end of the bytes handed out so far, and the total once the pieces ran out
+        self._served = 0
+        self._total = None
+
+    def chunksize(self):
+        return self._chunksize
+
+    def mimetype(self):
+        return self._mimetype
+
+    def size(self):
+        # googleapiclient asks for the size before every chunk and only finishes the
+        # upload on a short chunk or a known size; reading one chunk ahead makes the
+        # size known before the last chunk, even when the text ends exactly on a
+        # chunk boundary (which would otherwise end in an invalid empty chunk)
+        self._fill(self._served + self._chunksize + 1)
+        return self._total
+
+    def resumable(self):
+        return True
+
+    def has_stream(self):
+        return False
+
+    def getbytes(self, begin, length):
+        # everything before begin has been stored by drive and can be dropped;
+        # after a partial chunk drive may ask again for bytes we already produced
+        del self._buffer[: begin - self._start]
+        self._start = begin
+        self._fill(begin + length)
+        data = bytes(self._buffer[:length])
+        self._served = begin + len(data)
+        return data
+
+    def _fill(self, end):
+        """produce pieces until the bytes up to offset end are buffered or the pieces run out"""
+        while self._total is None and self._start + len(self._buffer) < end:
+            piece = next(self._pieces, None)
+            if piece is None:
+                self._total = self._start + len(self._buffer)
+            else:
+                self._buffer += piece.encode("utf-8")
+
+
+def json_array(records):
+    """Pieces of a JSON array of the records, serialized one record at a time."""
+    yield "["
+    for number, record in enumerate(records):
+        yield ("," if number else "") + json.dumps(record)
+    yield "]"
+
+
+def json_lines(records):
+    """Pieces of a JSON Lines file, one record per line."""
+    for record in records:
+        yield json.dumps(record) + "\n"
 
 
 class GDriveClient:
@@ -34,6 +119,8 @@ class GDriveClient:
         self.token_filename = token_filename
         self.credentials = self.authenticate()
         self.service = build("drive", "v3", credentials=self.credentials)
+        self._local = threading.local()
+        self._state_lock = threading.Lock()
 
     def authenticate(self):
         credentials = None
@@ -61,11 +148,27 @@ class GDriveClient:
         return credentials
 
     def upload_json(self, data, filename, folder_id=None, **kwargs):
+        # serialized piece by piece into the upload instead of into one big string
+        return self.upload_stream(
+            json.JSONEncoder().iterencode(data), filename, folder_id=folder_id
+        )
+
+    def upload_records(self, records, filename, folder_id=None, lines=False):
+        """
+        Upload records from any iterable, e.g. a generator over an api collection,
+        as a JSON array or with lines=True as JSON Lines, with flat memory use.
+        """
+        pieces = json_lines(records) if lines else json_array(records)
+        mimetype = "application/x-ndjson" if lines else "application/json"
+        return self.upload_stream(pieces, filename, folder_id, mimetype=mimetype)
+
+    def upload_stream(
+        self, pieces, filename, folder_id=None, mimetype="application/json"
+    ):
         file_metadata = {"name": filename}
         if folder_id:
             file_metadata["parents"] = [folder_id]
-        dh = BytesIO(json.dumps(data).encode("utf-8"))
-        media = MediaIoBaseUpload(dh, mimetype="application/json", resumable=True)
+        media = JsonStreamUpload(pieces, mimetype=mimetype)
         file = (
             self.service.files()
             .create(body=file_metadata, media_body=media, fields="id")
@@ -76,27 +179,339 @@ class GDriveClient:
     def upload_jsonfile(
         self, filename, destination_filename=None, folder_id=None, **kwargs
     ):
+        return self.upload_file(
+            filename,
+            destination_filename=(
+                filename if destination_filename is None else destination_filename
+            ),
+            folder_id=folder_id,
+            mimetype="application/json",
+        )["id"]
+
+    def thread_service(self):
+        """
+        Drive service for the calling thread: httplib2 is not thread safe, so every
+        thread gets its own connection while sharing the credentials.
+        """
+        if not hasattr(self._local, "service"):
+            http = AuthorizedHttp(self.credentials, http=httplib2.Http())
+            self._local.service = build("drive", "v3", http=http, cache_discovery=False)
+        return self._local.service
+
+    def upload_file(
+        self,
+        filename,
+        destination_filename=None,
+        folder_id=None,
+        mimetype=None,
+        state_file=None,
+        chunksize=CHUNK_SIZE,
+        num_retries=5,
+        file_id=None,
+    ):
+        """
+        Upload a file in resumable chunks, as a new file or, with file_id, as new
+        content of an existing one.
+
+        With state_file the upload session is saved there after the first chunk, so
+        an interrupted upload of the same file continues where it stopped.
+        Returns a dict with the file id, md5, size in bytes and seconds taken.
+        """
         file_metadata = {
-            "name": filename if destination_filename is None else destination_filename
+            "name": (
+                os.path.basename(filename)
+                if destination_filename is None
+                else destination_filename
+            )
         }
         if folder_id:
             file_metadata["parents"] = [folder_id]
-        media = MediaFileUpload(filename, mimetype="application/json", resumable=True)
-        file = (
-            self.service.files()
-            .create(body=file_metadata, media_body=media, fields="id")
-            .execute()
+        if mimetype is None:
+            mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        size = os.path.getsize(filename)
+        key = json.dumps(
+            [
+                os.path.abspath(filename),
+                file_metadata,
+                file_id,
+                size,
+                os.path.getmtime(filename),
+            ]
+        )
+
+        started = time.monotonic()
+        service = self.thread_service()
+        media = MediaFileUpload(
+            filename, mimetype=mimetype, chunksize=chunksize, resumable=True
         )
+        if file_id is None:
+            request = service.files().create(
+                body=file_metadata, media_body=media, fields="id, md5Checksum"
+            )
+        else:
+            request = service.files().update(
+                fileId=file_id, media_body=media, fields="id, md5Checksum"
+            )
+        response = None
+        if state_file is not None:
+            resumable_uri = self._load_state(state_file).get(key)
+            if resumable_uri is not None:
+                response = self._resume(request, resumable_uri, size)
+        while response is None:
+            _, response = request.next_chunk(num_retries=num_retries)
+            if state_file is not None and response is None:
+                self._save_state(state_file, key, request.resumable_uri)
+        if state_file is not None:
+            self._save_state(state_file, key, None)
+        return {
+            "id": response["id"],
+            "md5": response.get("md5Checksum"),
+            "bytes": size,
+            "seconds": time.monotonic() - started,
+        }
+
+    def upload_files(self, filenames, folder_id=None, workers=4, state_file=None):
+        """
+        Upload files concurrently. Yields (filename, result or exception) as they finish.
+        """
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(
+                    self.upload_file,
+                    filename,
+                    folder_id=folder_id,
+                    state_file=state_file,
+                ): filename
+                for filename in filenames
+            }
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    yield futures[future], future.result()
+                except Exception as error:
+                    yield futures[future], error
+
+    def list_folder(self, folder_id):
+        """Name -> {"id", "md5"} of the files in a folder, listed page by page."""
+        files = {}
+        page_token = None
+        while True:
+            response = (
+                self.service.files()
+                .list(
+                    q=f"'{folder_id}' in parents and trashed = false",
+                    fields="nextPageToken, files(id, name, md5Checksum)",
+                    orderBy="modifiedTime desc",
+                    pageSize=1000,
+                    pageToken=page_token,
+                )
+                .execute()
+            )
+            for file in response.get("files", []):
+                # with duplicate names keep the most recently modified one
+                files.setdefault(
+                    file["name"], {"id": file["id"], "md5": file.get("md5Checksum")}
+                )
+            page_token = response.get("nextPageToken")
+            if page_token is None:
+                return files
+
+    def folder_index(self, folder_id, index_file=None, refresh=False):
+        """
+        Name -> {"id", "md5"} of the files in a folder, from index_file when it has
+        the folder, else (or with refresh) by listing the folder once.
+        """
+        index = self._load_state(index_file) if index_file is not None else {}
+        if refresh or folder_id not in index:
+            index[folder_id] = self.list_folder(folder_id)
+            if index_file is not None:
+                self._save_index(index_file, folder_id, index[folder_id])
+        return index[folder_id]
+
+    def sync_files(
+        self,
+        filenames,
+        folder_id,
+        index_file=None,
+        refresh=False,
+        workers=4,
+        state_file=None,
+    ):
+        """
+        Upload files to a folder, skipping files whose name and md5 are already there
+        and updating files with the same name in place instead of adding a duplicate.
+        Files are named by their basename in the folder, so two files with the same
+        basename (e.g. from different subdirectories) are refused with a ValueError.
+        Yields (filename, "unchanged"/"updated"/"created", result or exception).
+        """
+        filenames = list(filenames)
+        duplicates = duplicate_names(filenames)
+        if duplicates:
+            raise ValueError(f"Files would share a name in the folder: {duplicates}")
+        index = self.folder_index(folder_id, index_file, refresh)
+        changes = {}
+        for filename in filenames:
+            name = os.path.basename(filename)
+            existing = index.get(name)
+            if existing is not None and existing["md5"] == file_md5(filename):
+                yield filename, "unchanged", existing
+            else:
+                changes[filename] = None if existing is None else existing["id"]
+
+        def sync(filename):
+            file_id = changes[filename]
+            if file_id is not None:
+                try:
+                    return "updated", self.upload_file(
+                        filename, file_id=file_id, state_file=state_file
+                    )
+                except HttpError as error:
+                    if error.resp.status != 404:
+                        raise
+                    # deleted in drive since the index was made
+            return "created", self.upload_file(
+                filename, folder_id=folder_id, state_file=state_file
+            )
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(sync, filename): filename for filename in changes
+            }
+            for future in concurrent.futures.as_completed(futures):
+                filename = futures[future]
+                try:
+                    action, result = future.result()
+                except Exception as error:
+                    yield filename, "failed", error
+                    continue
+                index[os.path.basename(filename)] = {
+                    "id": result["id"],
+                    "md5": result["md5"],
+                }
+                if index_file is not None:
+                    self._save_index(index_file, folder_id, index)
+                yield filename, action, result
+
+    def sync_json(self, data, filename, folder_id, index_file=None):
+        """
+        Like upload_json, but a no-op if the folder already holds the same content
+        under filename, and an in-place update if it holds other content.
+        Returns the file id.
+        """
+        content = json.dumps(data).encode("utf-8")
+        index = self.folder_index(folder_id, index_file)
+        existing = index.get(filename)
+        if existing is not None and existing["md5"] == hashlib.md5(content).hexdigest():
+            return existing["id"]
+        media = MediaIoBaseUpload(
+            BytesIO(content), mimetype="application/json", resumable=True
+        )
+        files = self.service.files()
+        if existing is None:
+            request = files.create(
+                body={"name": filename, "parents": [folder_id]},
+                media_body=media,
+                fields="id, md5Checksum",
+            )
+        else:
+            request = files.update(
+                fileId=existing["id"], media_body=media, fields="id, md5Checksum"
+            )
+        file = request.execute()
+        index[filename] = {"id": file["id"], "md5": file.get("md5Checksum")}
+        if index_file is not None:
+            self._save_index(index_file, folder_id, index)
         return file["id"]
 
+    def _resume(self, request, resumable_uri, size):
+        """
+        Ask Drive how much of an earlier upload session arrived and point the request
+        at it. Returns the file resource if it was already complete.
+        """
+        http = request.http
+        response, content = http.request(
+            resumable_uri,
+            "PUT",
+            headers={"Content-Range": f"bytes */{size}", "Content-Length": "0"},
+        )
+        if response.status in (200, 201):
+            return json.loads(content)
+        if response.status != 308:
+            # session expired or unknown, start over
+            return None
+        request.resumable_uri = resumable_uri
+        if "range" in response:
+            # e.g. "bytes=0-8388607"
+            request.resumable_progress = int(response["range"].split("-")[1]) + 1
+        return None
+
+    def _save_index(self, index_file, folder_id, files):
+        with self._state_lock:
+            index = {}
+            if os.path.exists(index_file):
+                with open(index_file) as file:
+                    index = json.load(file)
+            index[folder_id] = files
+            with open(index_file + ".tmp", "w") as file:
+                json.dump(index, file)
+            os.replace(index_file + ".tmp", index_file)
+
+    def _load_state(self, state_file):
+        with self._state_lock:
+            if not os.path.exists(state_file):
+                return {}
+            with open(state_file) as file:
+                return json.load(file)
+
+    def _save_state(self, state_file, key, resumable_uri):
+        with self._state_lock:
+            state = {}
+            if os.path.exists(state_file):
+                with open(state_file) as file:
+                    state = json.load(file)
+            if resumable_uri is None:
+                state.pop(key, None)
+            else:
+                state[key] = resumable_uri
+            with open(state_file + ".tmp", "w") as file:
+                json.dump(state, file)
+            os.replace(state_file + ".tmp", state_file)
+
+
+def file_md5(filename):
+    digest = hashlib.md5()
+    with open(filename, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def duplicate_names(filenames):
+    """{basename: filenames} of the basenames given by more than one file"""
+    by_name = {}
+    for filename in filenames:
+        by_name.setdefault(os.path.basename(filename), []).append(filename)
+    return {name: paths for name, paths in by_name.items() if len(paths) > 1}
+
+
+def expand_paths(paths):
+    """Files given directly, plus every file below the given directories."""
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, _, filenames in sorted(os.walk(path)):
+                for filename in sorted(filenames):
+                    yield os.path.join(directory, filename)
+        else:
+            yield path
 
-parser = argparse.ArgumentParser(description="Upload json file to googledrive.")
-parser.add_argument("json_file", type=str, help="File to upload.")
+parser = argparse.ArgumentParser(description="Upload files to googledrive.")
+parser.add_argument(
+    "files", nargs="+", type=str, help="Files or directories to upload."
+)
 parser.add_argument(
     "--destination_filename",
     "-n",
     type=str,
-    help="Name to give the file in google drive.",
+    help="Name to give the file in google drive, only with a single file.",
 )
 parser.add_argument(
     "--folder_id",
@@ -111,14 +526,81 @@ parser.add_argument(
     type=str,
     help="A client credentials file.",
 )
+parser.add_argument(
+    "--workers", default=4, type=int, help="Number of files uploaded at once."
+)
+parser.add_argument(
+    "--state_file",
+    default="gdrive_uploads.json",
+    type=str,
+    help="Where upload sessions are kept so interrupted uploads can resume.",
+)
+parser.add_argument(
+    "--sync",
+    action="store_true",
+    help="Skip files already in the folder with the same content, update changed ones in place.",
+)
+parser.add_argument(
+    "--index_file",
+    default="gdrive_index.json",
+    type=str,
+    help="Local index of the names and md5s of the files in the folder, used with --sync.",
+)
+parser.add_argument(
+    "--refresh_index",
+    action="store_true",
+    help="List the folder again instead of trusting the index file.",
+)
 
 
 if __name__ == "__main__":
     args = parser.parse_args()
+    filenames = list(expand_paths(args.files))
+    if args.destination_filename is not None and len(filenames) > 1:
+        parser.error("--destination_filename only works with a single file")
+    if args.sync and (args.folder_id is None or args.destination_filename is not None):
+        parser.error("--sync needs --folder_id and no --destination_filename")
+    if args.sync and duplicate_names(filenames):
+        parser.error(
+            f"files would share a name in the folder: {duplicate_names(filenames)}"
+        )
     drive = GDriveClient(args.credentials_filename)
-    file_id = drive.upload_jsonfile(
-        args.json_file,
-        destination_filename=args.destination_filename,
-        folder_id=args.folder_id,
-    )
-    print("uploaded file")
+    if args.destination_filename is not None:
+        result = drive.upload_file(
+            filenames[0],
+            destination_filename=args.destination_filename,
+            folder_id=args.folder_id,
+            state_file=args.state_file,
+        )
+        results = [(filenames[0], "created", result)]
+    elif args.sync:
+        results = drive.sync_files(
+            filenames,
+            args.folder_id,
+            index_file=args.index_file,
+            refresh=args.refresh_index,
+            workers=args.workers,
+            state_file=args.state_file,
+        )
+    else:
+        results = drive.upload_files(
+            filenames,
+            folder_id=args.folder_id,
+            workers=args.workers,
+            state_file=args.state_file,
+        )
+        results = (
+            (filename, "failed" if isinstance(result, Exception) else "created", result)
+            for filename, result in results
+        )
+    for filename, action, result in results:
+        if action == "failed":
+            print(f"{filename}: failed: {result}")
+        elif action == "unchanged":
+            print(f"{filename}: unchanged, skipped")
+        else:
+            rate = result["bytes"] / max(result["seconds"], 1e-6) / 1e6
+            print(
+                f"{filename}: {action}, {result['bytes']} bytes in "
+                f"{result['seconds']:.1f}s ({rate:.2f} MB/s)"
+            )
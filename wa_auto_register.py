@@ -1,10 +1,10 @@
 import datetime
-import urllib.parse
 
 import parse # pip install parse
 import numpy as np # pip install numpy
 
-from waapi import WildApricotClient
+from waapi import WildApricotClient, ResponseCache
+from contact_store import ContactStore
 from config import wild_apricot_api_key, ubc_auto_register_passphrase
 
 email = 'adam.subanloewen@gmail.com'
@@ -12,12 +12,12 @@ hours_before = 48
 event_url = 'https://ubcsailing.org/event-5915272'
 
 def get_member_by_email(email):
-    params = {'$filter': f'member eq true AND Email eq {email}',
-              '$top': '1',
-              '$async': 'false'}
-    request_url = contacts_requrl + '?' + urllib.parse.urlencode(params)
-    print(request_url)
-    return api.request(request_url).Contacts[0]
+    # a mirrored contact that is not a member may have joined since the last refresh, check with the api then
+    contact = contact_store.get_by_email(email, check=lambda contact: getattr(contact, 'MembershipEnabled', False))
+    if contact is None or not contact.MembershipEnabled:
+        message = f"No member found with email {email}"
+        raise ValueError(message) # reply with error message
+    return contact
 
 def register_for_event(event, contact, registration_type):
     body = {
@@ -41,16 +41,21 @@ if result is None:
     raise ValueError(message) # reply with error message
 event_id = result["event_id"]
 
-api = WildApricotClient(api_key=wild_apricot_api_key)
+# registration is decided on the event's current counts and RegistrationEnabled: always revalidate it,
+# only an unchanged event (304) is served from the cache
+response_cache = ResponseCache('wa_cache', ttls={'/events/': 0})
+api = WildApricotClient(api_key=wild_apricot_api_key, token_cache='token_wildapricot.json',
+                        resource_cache='wa_resources.json', response_cache=response_cache)
 api.authenticate_with_apikey()
 # print(api.request("/")) # to get latest API version
-accounts = api.request("/v2.3/accounts")
-account = accounts[0]
+api_version = 'v2.3'
 
-# print([res.Name for res in account.Resources])
-contacts_requrl = next(res for res in account.Resources if res.Name == 'Contacts').Url
-event_requrl = next(res for res in account.Resources if res.Name == 'Events').Url + event_id
-event_reg_requrl = next(res for res in account.Resources if res.Name == 'Event registrations').Url
+# print([res.Name for res in api.get_account(api_version).Resources])
+contacts_requrl = api.resource_url('Contacts', api_version)
+event_requrl = api.resource_url('Events', api_version) + event_id
+event_reg_requrl = api.resource_url('Event registrations', api_version)
+contact_store = ContactStore(api, contacts_url=contacts_requrl)
+contact_store.refresh()
 
 contact = get_member_by_email(email)
 event = api.request(event_requrl)
@@ -71,6 +76,7 @@ if not event.RegistrationEnabled:
 
 registration = register_for_event(event, contact, registration_type)
 print(registration)
+print(response_cache.stats())
 
 # RPC requests don't work; so manually create invoice and payment, and settle invoice with payment all using the API
 # reply to user with message to ignore the "pending payment" email and confirm it worked
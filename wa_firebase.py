@@ -1,4 +1,12 @@
+import argparse
+import concurrent.futures
 import datetime
+import fcntl
+import hashlib
+import json
+import os
+import time
+import traceback
 import tzlocal
 import urllib.parse
 
@@ -6,10 +14,15 @@ import urllib.parse
 import firebase_admin
 from firebase_admin import credentials
 from firebase_admin import firestore
+from google.api_core import exceptions as google_exceptions
 
-from waapi import WildApricotClient, APIObject
+from waapi import WildApricotClient, APIObject, ResponseCache
 from config import wild_apricot_api_key
 
+FIRESTORE_BATCH_LIMIT = 500 # max writes per batched commit
+# active members, excluding Social Members (level 1144628)
+ACTIVE_MEMBERS_FILTER = "Member eq true AND 'Membership status' eq Active AND 'Membership level ID' ne 1144628"
+
 
 def now():
     return datetime.datetime.now(tz=tzlocal.get_localzone())
@@ -17,7 +30,7 @@ def now():
 
 def clean(data):
     if isinstance(data, APIObject):
-        return data._json_cleans()
+        return data.to_plain()
     if isinstance(data, tuple):
         return tuple(clean(elem) for elem in data)
     if isinstance(data, list):
@@ -30,16 +43,16 @@ class WildApricotCustomClient(WildApricotClient):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.authenticate_with_apikey()
-        accounts = self.request("/v2/accounts")
-        self.account = accounts[0]
+        self.account = self.get_account()
 
-        self.contacts_requrl = next(res for res in self.account.Resources if res.Name == 'Contacts').Url
-        self.groups_requrl = next(res for res in self.account.Resources if res.Name == 'Member groups').Url
+        self.contacts_requrl = self.contacts_url
+        self.groups_requrl = self.member_groups_url
 
     def get_changed_members_since_datetime(self, datetime, fields):
         """
         All WA contacts that have been created (website profile or membership) or
         modified (changed level or edited profile including card number or equipment certs) since datetime.
+        Contacts are yielded lazily, one page at a time.
 
         Notes
         -----
@@ -55,38 +68,295 @@ class WildApricotCustomClient(WildApricotClient):
         https://app.swaggerhub.com/apis-docs/WildApricot/wild-apricot_public_api/7.24.0#/Contacts/GetContactsList
 
         """
-        params = {'$filter': (f"Member eq true AND 'Membership status' eq Active AND 'Membership level ID' ne 1144628 AND ("
+        params = {'$filter': (f"{ACTIVE_MEMBERS_FILTER} AND ("
                               f"'Creation date' ge {datetime.isoformat()} OR 'Member since' ge {datetime.isoformat()} OR "
                               f"'Level last changed' ge {datetime.isoformat()} OR "
                               f"'Profile last updated' ge {datetime.isoformat()})"),
-                  '$select': ','.join(f"'{field}'" for field in fields),
-                  '$async': 'false'}
-        request_url = self.contacts_requrl + '?' + urllib.parse.urlencode(params)
-        return self.request(request_url).Contacts
+                  '$select': ','.join(f"'{field}'" for field in fields)}
+        query = self.submit_query(self.contacts_requrl, params, collection_key='Contacts')
+        return iter(query)
+
+    def get_active_members(self, fields, page_size=100, max_concurrency=4):
+        """
+        Snapshot of all active WA members, as (count, contacts).
+        The query is built once on the server ($async=true) and paged through its result, so the pages stay
+        stable even if members join, lapse or change meanwhile; count is the size of that same result.
+        The pages are fetched in parallel and their contacts yielded as each page arrives, in no particular order.
+        """
+        params = {'$filter': ACTIVE_MEMBERS_FILTER,
+                  '$select': ','.join(f"'{field}'" for field in fields)}
+        query = self.submit_query(self.contacts_requrl, params, collection_key='Contacts').wait()
+        separator = '&' if '?' in query.result_url else '?'
+        count = self.request(query.result_url + separator + urllib.parse.urlencode({'$count': 'true'})).Count
+
+        def contacts():
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+                pages = [executor.submit(self.request, self._page_url(query.result_url, {}, skip, page_size))
+                         for skip in range(0, count, page_size)]
+                for page in concurrent.futures.as_completed(pages):
+                    yield from page.result().Contacts
+
+        return count, contacts()
+
+def contact_data(contact, fields):
+    data = {}
+    for field in contact.FieldValues:
+        if field.FieldName in fields:
+            data[field.FieldName] = clean(field.Value)
+    return data
+
+
+def content_hash(data):
+    return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+
 
+def load_hash_index(filename):
+    """{document_id: content hash} of what was last written to Firestore"""
+    try:
+        with open(filename) as index_file:
+            return json.load(index_file)
+    except (OSError, ValueError):
+        return {}
 
-def upload_changes(collection, updated_contacts, fields):
+
+def save_hash_index(filename, index):
+    with open(filename + '.tmp', 'w') as index_file:
+        json.dump(index, index_file)
+    os.replace(filename + '.tmp', filename)
+
+
+def commit_batch(db, collection, documents, max_retries=3):
+    """
+    Write {document_id: data} in one batched commit, retrying with backoff.
+    A batch is atomic, so a failed commit wrote nothing and can be retried as a whole.
+    """
+    for attempt in range(max_retries + 1):
+        batch = db.batch()
+        for document_id, data in documents.items():
+            batch.set(collection.document(document_id), data) # overwrites if exists!
+        try:
+            batch.commit()
+            return
+        except google_exceptions.GoogleAPICallError:
+            if attempt == max_retries:
+                raise
+            time.sleep(2 ** attempt)
+
+
+def upload_changes(db, collection, updated_contacts, fields, batch_size=FIRESTORE_BATCH_LIMIT, index=None,
+                   max_concurrency=1):
+    """
+    Upload contacts in batched commits of up to batch_size documents (WA Contact ID as document ID).
+    Batches that still fail after retries are skipped and reported together at the end, so one bad batch
+    does not stop the rest; the raised error keeps the caller from checkpointing a partial sync.
+
+    index -- optional {document_id: content hash} of the mirrored fields as last written; contacts whose
+             mirrored fields did not change are skipped, and the index is updated for every written document
+    max_concurrency -- number of batches committed at once; commits run while contacts are still coming in
+    """
     uploaded_contacts = {}
-    for contact in updated_contacts:
-        document_id = str(contact.Id)
-        doc = collection.document(document_id) # using WA Contact ID for document
-        data = {}
-        for field in contact.FieldValues:
-            if field.FieldName in fields:
-                data[field.FieldName] = clean(field.Value)
-        uploaded_contacts[document_id] = data
-        doc.set(data) # overwrites if exists!
+    failed_ids = []
+    skipped = 0
+    started = time.monotonic()
+    pending = {}
+    commits = {}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        def flush():
+            documents = dict(pending)
+            commits[executor.submit(commit_batch, db, collection, documents)] = documents
+            pending.clear()
+
+        for contact in updated_contacts:
+            document_id = str(contact.Id)
+            data = contact_data(contact, fields)
+            if index is not None and index.get(document_id) == content_hash(data):
+                skipped += 1
+                continue
+            pending[document_id] = data
+            if len(pending) >= batch_size:
+                flush()
+        if pending:
+            flush()
+
+        for commit, documents in commits.items():
+            try:
+                commit.result()
+            except google_exceptions.GoogleAPICallError:
+                failed_ids.extend(documents)
+                continue
+            uploaded_contacts.update(documents)
+            if index is not None:
+                index.update((document_id, content_hash(data)) for document_id, data in documents.items())
+
+    elapsed = time.monotonic() - started
+    print(f"wrote {len(uploaded_contacts)} documents in {elapsed:.1f}s "
+          f"({len(uploaded_contacts) / max(elapsed, 1e-6):.0f} docs/s), {skipped} unchanged skipped")
+    if failed_ids:
+        raise RuntimeError(f"Failed to write {len(failed_ids)} documents: {failed_ids}")
+    return uploaded_contacts
+
+
+class SyncLock:
+    """
+    Exclusive lock on a file so only one sync (cron run or daemon) writes to Firestore at a time.
+    The lock is released by the OS if the process dies, so a crashed run never blocks the next one.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = None
+
+    def __enter__(self):
+        self._file = open(self.filename, 'a')
+        try:
+            fcntl.flock(self._file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._file.close()
+            raise RuntimeError(f"Another sync holds {self.filename}, not starting a second writer.") from None
+        return self
+
+    def __exit__(self, *exc_info):
+        fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._file.close()
+
+
+def read_watermark(filename, default):
+    try:
+        with open(filename) as checkpoint:
+            return datetime.datetime.fromisoformat(json.load(checkpoint)['watermark'])
+    except (OSError, ValueError, KeyError):
+        return default
+
+
+def write_watermark(filename, watermark):
+    # write then rename, so a crash never leaves a truncated checkpoint behind
+    with open(filename + '.tmp', 'w') as checkpoint:
+        json.dump({'watermark': watermark.isoformat()}, checkpoint)
+    os.replace(filename + '.tmp', filename)
+
+
+def coalesce(contacts):
+    """keep only the latest version of each contact Id"""
+    latest = {}
+    for contact in contacts:
+        latest[contact.Id] = contact
+    return latest
+
+
+def delete_documents(db, collection, document_ids, batch_size=FIRESTORE_BATCH_LIMIT):
+    document_ids = list(document_ids)
+    for start in range(0, len(document_ids), batch_size):
+        batch = db.batch()
+        for document_id in document_ids[start:start + batch_size]:
+            batch.delete(collection.document(document_id))
+        batch.commit()
+
+
+def full_resync(api, db, collection, fields, checkpoint, index_file=None, max_concurrency=4):
+    """
+    Rebuild the collection from scratch: write every active member, pipelined so pages are committed while
+    others are still being fetched, then delete documents of contacts that are no longer active members.
+    Nothing is deleted, and the high-water mark is left alone, unless every member of the snapshot was written.
+    Afterwards the hash index and the high-water mark describe exactly what was written.
+    """
+    started = now()
+    count, contacts = api.get_active_members(fields, max_concurrency=max_concurrency)
+    index = {}
+    uploaded_contacts = upload_changes(db, collection, contacts, fields, index=index, max_concurrency=max_concurrency)
+    if len(uploaded_contacts) != count:
+        # a member missing from the pages must not lose their document; leave the deletion for the next resync
+        if index_file:
+            save_hash_index(index_file, index)
+        raise RuntimeError(f"Fetched {len(uploaded_contacts)} distinct members but Wild Apricot counts {count}, "
+                           f"not deleting any documents")
+    stale_ids = [doc.id for doc in collection.list_documents() if doc.id not in uploaded_contacts]
+    delete_documents(db, collection, stale_ids)
+    print(f"deleted {len(stale_ids)} documents of inactive members")
+    if index_file:
+        save_hash_index(index_file, index)
+    write_watermark(checkpoint, started - datetime.timedelta(minutes=1))
     return uploaded_contacts
 
 
+def sync_once(api, db, collection, fields, checkpoint, index_file=None, overlap=datetime.timedelta(minutes=1)):
+    """
+    Upload every contact changed since the checkpointed high-water mark, then advance the mark.
+    The mark only moves after a successful upload, so a failed or missed run is picked up by the next one.
+    The next query starts `overlap` before this one did, to tolerate clock skew with Wild Apricot;
+    re-uploading a contact is harmless since documents are overwritten.
+    With index_file, contacts whose mirrored fields are unchanged since their last write are not written.
+    """
+    started = now()
+    since = read_watermark(checkpoint, started - datetime.timedelta(minutes=5))
+    index = load_hash_index(index_file) if index_file else None
+    updated_contacts = coalesce(api.get_changed_members_since_datetime(since, fields))
+    try:
+        uploaded_contacts = upload_changes(db, collection, updated_contacts.values(), fields, index=index)
+    finally:
+        # documents that were written are recorded even if other batches failed
+        if index_file:
+            save_hash_index(index_file, index)
+    write_watermark(checkpoint, started - overlap)
+    return uploaded_contacts
+
+
+def run_daemon(api, db, collection, fields, checkpoint, interval, index_file=None):
+    """
+    poll Wild Apricot every `interval` seconds; changes to a contact within one interval are written once.
+    A failed poll is logged and retried on the next one: the high-water mark only advances on success.
+    """
+    while True:
+        started = time.monotonic()
+        try:
+            uploaded_contacts = sync_once(api, db, collection, fields, checkpoint, index_file)
+        except Exception:
+            print(f"{now().isoformat()}: sync failed, retrying in {interval}s")
+            traceback.print_exc()
+        else:
+            print(f"{now().isoformat()}: uploaded {len(uploaded_contacts)} contacts")
+        time.sleep(max(0, interval - (time.monotonic() - started)))
+
+
+parser = argparse.ArgumentParser(description="Mirror Wild Apricot member changes to Firestore.")
+parser.add_argument("--daemon", action="store_true", help="Keep running and poll for changes.")
+parser.add_argument(
+    "--full-resync",
+    action="store_true",
+    help="Rewrite the collection with all active members and delete the others, before any polling.",
+)
+parser.add_argument("--workers", default=4, type=int, help="Parallel page fetches and commits of a full resync.")
+parser.add_argument("--interval", default=60, type=float, help="Seconds between polls in daemon mode.")
+parser.add_argument("--table", default="auto_members_test", type=str, help="Firestore collection to write to.")
+parser.add_argument(
+    "--checkpoint",
+    default="wa_firebase_checkpoint.json",
+    type=str,
+    help="File keeping the high-water mark of the last successful sync.",
+)
+parser.add_argument(
+    "--index_file",
+    default=None,
+    type=str,
+    help="Content-hash index of mirrored fields, to skip no-op writes. Default: wa_firebase_index_<table>.json",
+)
+parser.add_argument(
+    "--lock_file",
+    default="wa_firebase.lock",
+    type=str,
+    help="Lock file guaranteeing a single writer across overlapping runs.",
+)
+
+
 if __name__ == '__main__':
-    since = now() - datetime.timedelta(minutes=5)
+    args = parser.parse_args()
     fields = ['First name', 'Last name', 'Jericho Card Number', 'Equipment certification achieved']
 
     # WA
-    api = WildApricotCustomClient(api_key=wild_apricot_api_key)
-    updated_contacts = api.get_changed_members_since_datetime(since, fields)
-    print(updated_contacts)
+    response_cache = ResponseCache('wa_cache', ttls={'/membergroups': 24 * 3600})
+    api = WildApricotCustomClient(api_key=wild_apricot_api_key, token_cache='token_wildapricot.json',
+                                  resource_cache='wa_resources.json', response_cache=response_cache,
+                                  background_refresh=args.daemon)
 
     groups = api.request(api.groups_requrl)
     # list of all groups may be useful for UI in case new ones are added
@@ -99,10 +369,19 @@ if __name__ == '__main__':
     # }
 
     # Firebase
-    table = 'auto_members_test'
     cred = credentials.Certificate("firebasedb_admin_sdk_secret.json")
     firebase_admin.initialize_app(cred, {'projectId': 'digital-logbook-database'})
     db = firestore.client()
 
-    uploaded_contacts = upload_changes(db.collection(table), updated_contacts, fields)
-    print(uploaded_contacts)
+    index_file = args.index_file or f"wa_firebase_index_{args.table}.json"
+    with SyncLock(args.lock_file):
+        if args.full_resync:
+            uploaded_contacts = full_resync(api, db, db.collection(args.table), fields, args.checkpoint, index_file,
+                                            max_concurrency=args.workers)
+            print(f"resynced {len(uploaded_contacts)} members")
+        if args.daemon:
+            run_daemon(api, db, db.collection(args.table), fields, args.checkpoint, args.interval, index_file)
+        elif not args.full_resync:
+            uploaded_contacts = sync_once(api, db, db.collection(args.table), fields, args.checkpoint, index_file)
+            print(uploaded_contacts)
+    print(response_cache.stats())
@@ -13,62 +13,55 @@ Example:
 
 __author__ = 'dsmirnov@wildapricot.com'
 
+import concurrent.futures
 import datetime
-import urllib.request
-import urllib.response
+import http.client
+import io
+import threading
+import time
 import urllib.error
 import urllib.parse
 import json
 import base64
+import hashlib
+import os
+import codecs
+import collections
+import random
+import tempfile
 
+try:
+    import orjson  # optional fast json encoder: pip install orjson
+except ImportError:
+    orjson = None
 
-class WildApricotClient:
-    """Wild apricot API client."""
+
+class _BaseClient:
+    """Credentials and token bookkeeping shared by WildApricotClient and waapi_async.AsyncWildApricotClient"""
     auth_endpoint = "https://oauth.wildapricot.org/auth/token"
     api_endpoint = "https://api.wildapricot.org"
-    _token = None
+    # background refresh happens this long before a token counts as expired
+    refresh_lead = datetime.timedelta(seconds=60)
 
-    def __init__(self, client_id=None, client_secret=None, *, api_key=None):
-        """
-        client_id -- client id from account settings
-        client_secret -- client secret from account settings
-        api_key -- secret api key from account settings (alternative for servers)
-        """
+    def __init__(self, client_id=None, client_secret=None, *, api_key=None, token_cache=None):
         self.client_id = client_id
         self.client_secret = client_secret
         self.api_key = api_key
+        self.token_cache = token_cache
         self._api_key_refresh_scope = None
+        self._token = None
+        self._token_cache_key = None
 
-    def request_token(self, data, authorization):
-        encoded_data = urllib.parse.urlencode(data).encode()
-        request = urllib.request.Request(self.auth_endpoint, encoded_data, method="POST")
-        request.add_header("ContentType", "application/x-www-form-urlencoded")
-        auth_header = base64.standard_b64encode(authorization.encode()).decode()
-        request.add_header("Authorization", 'Basic ' + auth_header)
-        response = urllib.request.urlopen(request)
-        self._token = self._parse_response(response)
-        self._token.retrieved_at = datetime.datetime.now()
-
-    def authenticate_with_apikey(self, scope='auto'):
-        """perform authentication by api key and store result for request method
-        scope -- optional scope of authentication request. If `auto` full list of API scopes will be used.
-        """
+    def _apikey_grant(self, scope):
         if self.api_key is None:
             raise APIException("API key was not provided when initializing.")
         data = {
             "grant_type": "client_credentials",
             "scope": scope
         }
-        self.request_token(data, 'APIKEY:' + self.api_key)
-        self._api_key_refresh_scope = scope
+        return data, 'APIKEY:' + self.api_key
 
-    def authenticate_with_contact_credentials(self, username, password, scope='auto'):
-        """perform authentication by contact credentials and store result for request method
-
-        username -- typically a contact email
-        password -- contact password
-        scope -- optional scope of authentication request. If `auto` full list of API scopes will be used.
-        """
+    def _contact_grant(self, username, password, scope):
         if self.client_id is None or self.client_secret is None:
             raise APIException("Client id or secret was not provided when initializing.")
         data = {
@@ -77,20 +70,83 @@ class WildApricotClient:
             "password": password,
             "scope": scope
         }
-        self.request_token(data, self.client_id + ':' + self.client_secret)
+        return data, self.client_id + ':' + self.client_secret
 
-    def request(self, api_url, post_payload=None, method=None):
-        """
-        perform api request and return result as an instance of APIObject or list of APIObjects
+    def _refresh_grant(self):
+        """grant to refresh the token with; with an api key the token is simply requested again"""
+        if self.api_key is not None:
+            return self._apikey_grant(self._api_key_refresh_scope)
+        data = {
+            "grant_type": "refresh_token",
+            "refresh_token": self._token.refresh_token
+        }
+        return data, self.client_id + ':' + self.client_secret
 
-        api_url -- absolute or relative api resource url
-        post_payload -- any json serializable object to send to API
-        method -- HTTP method of api request. Default: GET if post_payload is None else POST
+    @staticmethod
+    def _token_request(data, authorization):
+        """encoded body and headers of an oauth token request"""
+        encoded_data = urllib.parse.urlencode(data).encode()
+        auth_header = base64.standard_b64encode(authorization.encode()).decode()
+        headers = {
+            "Content-Type": "application/x-www-form-urlencoded",
+            "Authorization": 'Basic ' + auth_header,
+        }
+        return encoded_data, headers
+
+    def _set_token(self, token):
+        # the token is complete before it is published, readers never see a half-written one
+        if not hasattr(token, 'retrieved_at'):
+            token.retrieved_at = datetime.datetime.now()
+        self._token = token
+
+    def _cached_token(self, data, authorization, refresh=False):
         """
+        remember which identity the token belongs to and return a still valid token for it from token_cache,
+        or None. Refresh grants keep the identity of the token they refresh, and never take a token from the
+        cache: it would be the very token being refreshed.
+        Tokens within refresh_lead of expiring are not reused either.
+        """
+        if data["grant_type"] != "refresh_token":
+            identity = json.dumps([authorization, data.get("username"), data.get("scope")])
+            self._token_cache_key = hashlib.sha256(identity.encode()).hexdigest()
+        if self.token_cache is None or refresh or data["grant_type"] == "refresh_token":
+            return None
+        try:
+            with open(self.token_cache) as cache_file:
+                state = json.load(cache_file)[self._token_cache_key]
+        except (OSError, ValueError, KeyError):
+            return None
+        token = APIObject(state)
+        token.retrieved_at = datetime.datetime.fromisoformat(state['retrieved_at'])
+        if datetime.datetime.now() > self._token_expires_at(token) - self.refresh_lead:
+            return None
+        return token
+
+    def _save_cached_token(self, token):
+        if self.token_cache is None or self._token_cache_key is None:
+            return
+        try:
+            with open(self.token_cache) as cache_file:
+                cache = json.load(cache_file)
+        except (OSError, ValueError):
+            cache = {}
+        cache[self._token_cache_key] = token.to_plain()
+        _write_json_atomic(self.token_cache, cache)
+
+    def _token_expires_at(self, token=None):
+        token = token or self._token
+        return token.retrieved_at + datetime.timedelta(seconds=token.expires_in - 100)
+
+    def _token_expired(self, token=None):
+        return datetime.datetime.now() > self._token_expires_at(token)
+
+    def _check_authenticated(self):
         if self._token is None:
             raise APIException("Access token is not abtained. "
                                "Call authenticate_with_apikey or authenticate_with_contact_credentials first.")
 
+    def _api_request(self, api_url, post_payload, method):
+        """absolute url, HTTP method and encoded body of an api request"""
         if not api_url.startswith("http"):
             api_url = self.api_endpoint + api_url
 
@@ -100,51 +156,795 @@ class WildApricotClient:
             else:
                 method = "POST"
 
-        request = urllib.request.Request(api_url, method=method)
+        data = None
         if post_payload is not None:
-            request.data = json.dumps(post_payload, cls=_APIObjectEncoder).encode()
+            data = _json_dumps(post_payload)
+        return api_url, method, data
+
+    @staticmethod
+    def _api_headers(access_token):
+        return {
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+            "Authorization": "Bearer " + access_token,
+        }
 
-        request.add_header("Content-Type", "application/json")
-        request.add_header("Accept", "application/json")
-        request.add_header("Authorization", "Bearer " + self._get_access_token())
+    @staticmethod
+    def _collection_params(params, query_result=False):
+        params = dict(params or {})
+        if not query_result:  # result urls of async queries are already built
+            params.setdefault('$async', 'false')
+        return params
+
+    @staticmethod
+    def _page_url(api_url, params, skip, page_size):
+        page_params = dict(params, **{'$skip': str(skip), '$top': str(page_size)})
+        separator = '&' if '?' in api_url else '?'
+        return api_url + separator + urllib.parse.urlencode(page_params)
 
+    @staticmethod
+    def _wrap_response(decoded):
+        if isinstance(decoded, list):
+            result = []
+            for item in decoded:
+                result.append(APIObject(item))
+            return result
+        elif isinstance(decoded, dict):
+            return APIObject(decoded)
+        else:
+            return None
+
+    @staticmethod
+    def _collection_items(response, collection_key=None):
+        if isinstance(response, list):
+            return response
+        if collection_key is not None:
+            return getattr(response, collection_key)
+        for key, value in response._state.items():
+            if isinstance(value, list):
+                return getattr(response, key)
+        raise APIException("Response does not contain a collection: " + str(response))
+
+
+class WildApricotClient(_BaseClient):
+    """Wild apricot API client."""
+
+    def __init__(self, client_id=None, client_secret=None, *, api_key=None, pool_size=4, timeout=60,
+                 token_cache=None, background_refresh=False, resource_cache=None, resource_ttl=24 * 3600,
+                 response_cache=None):
+        """
+        client_id -- client id from account settings
+        client_secret -- client secret from account settings
+        api_key -- secret api key from account settings (alternative for servers)
+        pool_size -- max number of idle keep-alive connections kept open per host
+        timeout -- socket timeout in seconds for every api call
+        token_cache -- optional json file to keep access tokens in, so short runs can skip authentication
+        background_refresh -- refresh the token on a background thread shortly before it expires
+        resource_cache -- optional json file to keep the account and its resource urls in between runs
+        resource_ttl -- seconds after which the cached account is fetched again
+        response_cache -- optional ResponseCache serving repeated GET requests locally
+        """
+        super().__init__(client_id, client_secret, api_key=api_key, token_cache=token_cache)
+        self.background_refresh = background_refresh
+        self._pool = _ConnectionPool(maxsize=pool_size, timeout=timeout)
+        self._token_lock = threading.Lock()
+        self._refresh_timer = None
+        self.resource_cache = resource_cache
+        self.resource_ttl = resource_ttl
+        self._accounts = {}
+        self.response_cache = response_cache
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """close all pooled connections and stop background refresh; the client can still be used afterwards"""
+        if self._refresh_timer is not None:
+            self._refresh_timer.cancel()
+        self._pool.close()
+
+    def request_token(self, data, authorization, *, refresh=False):
+        token = self._cached_token(data, authorization, refresh)
+        if token is None:
+            encoded_data, headers = self._token_request(data, authorization)
+            response = self._pool.urlopen("POST", self.auth_endpoint, encoded_data, headers)
+            token = self._parse_response(response)
+            token.retrieved_at = datetime.datetime.now()
+            self._save_cached_token(token)
+        self._set_token(token)
+        if self.background_refresh:
+            self._schedule_refresh()
+
+    def authenticate_with_apikey(self, scope='auto'):
+        """perform authentication by api key and store result for request method
+        scope -- optional scope of authentication request. If `auto` full list of API scopes will be used.
+        """
+        self.request_token(*self._apikey_grant(scope))
+        self._api_key_refresh_scope = scope
+
+    def authenticate_with_contact_credentials(self, username, password, scope='auto'):
+        """perform authentication by contact credentials and store result for request method
+
+        username -- typically a contact email
+        password -- contact password
+        scope -- optional scope of authentication request. If `auto` full list of API scopes will be used.
+        """
+        self.request_token(*self._contact_grant(username, password, scope))
+
+    def request(self, api_url, post_payload=None, method=None, *, stream=None):
+        """
+        perform api request and return result as an instance of APIObject or list of APIObjects
+
+        api_url -- absolute or relative api resource url
+        post_payload -- any json serializable object to send to API
+        method -- HTTP method of api request. Default: GET if post_payload is None else POST
+        stream -- opt-in incremental parsing: True to stream the items of a top-level json array, or the name of
+                  the array attribute to stream, e.g. 'Contacts'. A generator of APIObjects is returned instead,
+                  items are decoded as they arrive off the socket so the whole response is never held in memory.
+        """
+        self._check_authenticated()
+        api_url, method, data = self._api_request(api_url, post_payload, method)
+        headers = self._api_headers(self._get_access_token())
+
+        cache = self.response_cache
+        if cache is not None and method == "GET" and not stream and cache.ttl(api_url) is not None:
+            return self._cached_request(cache, api_url, headers)
+
+        response = self._urlopen(method, api_url, data, headers)
+        if stream:
+            return self._stream_response(response, None if stream is True else stream)
+        return self._parse_response(response)
+
+    def _urlopen(self, method, api_url, data, headers):
         try:
-            response = urllib.request.urlopen(request)
-            return self._parse_response(response)
+            return self._pool.urlopen(method, api_url, data, headers)
         except urllib.error.HTTPError as http_err:
             if http_err.code == 400:
                 raise APIException(http_err.read())
             else:
                 raise
 
+    def _cached_request(self, cache, api_url, headers):
+        entry = cache.get(api_url)
+        if entry is not None:
+            if time.time() - entry['stored_at'] < cache.ttl(api_url):
+                cache.count('hits')
+                return self._wrap_response(json.loads(entry['body']))
+            if entry.get('etag'):
+                headers["If-None-Match"] = entry['etag']
+            if entry.get('last_modified'):
+                headers["If-Modified-Since"] = entry['last_modified']
+
+        response = self._urlopen("GET", api_url, None, headers)
+        body = response.read().decode()
+        if response.status == 304 and entry is not None:
+            cache.count('revalidations')
+            body = entry['body']
+        else:
+            cache.count('misses')
+        cache.put(api_url, body, response.getheader('ETag'), response.getheader('Last-Modified'))
+        return self._wrap_response(json.loads(body))
+
+    def get_account(self, api_version='v2'):
+        """
+        return the account of the api key or contact, with its Resources urls; resolved once per client
+        and, if resource_cache is set, shared between runs until resource_ttl has passed
+        """
+        account = self._accounts.get(api_version)
+        if account is None:
+            state = self._cached_account(api_version)
+            if state is None:
+                state = self.request(f"/{api_version}/accounts")[0].to_plain()
+                self._save_cached_account(api_version, state)
+            account = self._accounts[api_version] = APIObject(state)
+        return account
+
+    def resource_url(self, name, api_version='v2'):
+        """url of an account resource by name, e.g. 'Contacts', 'Events', 'Event registrations', 'Member groups'"""
+        for resource in self.get_account(api_version).Resources:
+            if resource.Name == name:
+                return resource.Url
+        raise APIException(f"Account has no resource named {name!r}")
+
+    @property
+    def contacts_url(self):
+        return self.resource_url('Contacts')
+
+    @property
+    def events_url(self):
+        return self.resource_url('Events')
+
+    @property
+    def event_registrations_url(self):
+        return self.resource_url('Event registrations')
+
+    @property
+    def member_groups_url(self):
+        return self.resource_url('Member groups')
+
+    def _cached_account(self, api_version):
+        # entries are kept per identity, the same key as the token cache: another api key or login sharing
+        # the file must not get this one's account
+        if self.resource_cache is None or self._token_cache_key is None:
+            return None
+        try:
+            with open(self.resource_cache) as cache_file:
+                cached = json.load(cache_file)[self._token_cache_key][api_version]
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        if time.time() - cached['retrieved_at'] > self.resource_ttl:
+            return None
+        return cached['account']
+
+    def _save_cached_account(self, api_version, state):
+        if self.resource_cache is None or self._token_cache_key is None:
+            return
+        try:
+            with open(self.resource_cache) as cache_file:
+                cache = json.load(cache_file)
+        except (OSError, ValueError):
+            cache = {}
+        cache.setdefault(self._token_cache_key, {})[api_version] = {'retrieved_at': time.time(), 'account': state}
+        _write_json_atomic(self.resource_cache, cache)
+
+    def iter_collection(self, api_url, params=None, page_size=100, *, collection_key=None, prefetch=False,
+                        query_result=False):
+        """
+        page through a collection with $skip/$top and yield its items one at a time as APIObjects
+
+        api_url -- absolute or relative api resource url, without query string
+        params -- dict of extra query parameters, e.g. $filter or $select
+        page_size -- number of items requested per call ($top)
+        collection_key -- name of the list attribute holding the items, e.g. 'Contacts'.
+                          Default: the response itself if it is a list, else its first list attribute
+        prefetch -- fetch the next page on a background thread while the current one is being consumed
+        query_result -- api_url is the ResultUrl of an async query (see submit_query), page it as it is
+        """
+        params = self._collection_params(params, query_result)
+
+        def fetch(skip):
+            return self._collection_items(self.request(self._page_url(api_url, params, skip, page_size)),
+                                          collection_key)
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1) if prefetch else None
+        try:
+            skip = 0
+            items = fetch(skip)
+            while True:
+                skip += page_size
+                pending = None
+                if executor is not None and len(items) >= page_size:
+                    pending = executor.submit(fetch, skip)
+                yield from items
+                if len(items) < page_size:
+                    return
+                items = pending.result() if pending is not None else fetch(skip)
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=False, cancel_futures=True)
+
+    def bulk(self, requests, max_concurrency=4, *, rate_limit=60, per=60, max_retries=4, backoff=1,
+             retry_post=False):
+        """
+        perform many api requests concurrently and return a list of BulkResult in the same order as requests.
+        A failed item does not stop the others, its exception is stored in BulkResult.error instead.
+
+        requests -- iterable of api urls, tuples of request() positional arguments (api_url, post_payload, method)
+                    or dicts of request() keyword arguments
+        max_concurrency -- number of requests in flight at once
+        rate_limit, per -- at most rate_limit requests are started per `per` seconds (token bucket)
+        max_retries -- retries of 429, 5xx and connection errors, with jittered exponential backoff.
+                       A POST (or PATCH) may have been applied when a 5xx or connection error comes back, so it
+                       is only retried on 429 unless retry_post is set
+        backoff -- base delay in seconds of the backoff; Retry-After from the server takes precedence
+        retry_post -- also retry POST/PATCH on 5xx and connection errors, for requests that are safe to repeat
+        """
+        bucket = _TokenBucket(rate_limit, per)
+
+        def perform(item):
+            if isinstance(item, str):
+                args, kwargs = (item,), {}
+            elif isinstance(item, dict):
+                args, kwargs = (), item
+            else:
+                args, kwargs = tuple(item), {}
+            call = dict(zip(('api_url', 'post_payload', 'method'), args), **kwargs)
+            method = call.get('method') or ('GET' if call.get('post_payload') is None else 'POST')
+            idempotent = method.upper() in ('GET', 'HEAD', 'PUT', 'DELETE') or retry_post
+            for attempt in range(max_retries + 1):
+                bucket.acquire()
+                retry_after = None
+                try:
+                    return BulkResult(item, self.request(*args, **kwargs), None)
+                except urllib.error.HTTPError as http_err:
+                    error = http_err
+                    if http_err.code != 429 and (http_err.code < 500 or not idempotent):
+                        break
+                    retry_after = http_err.headers.get('Retry-After') if http_err.headers else None
+                except APIException as api_err:
+                    error = api_err
+                    break
+                except OSError as os_err:
+                    error = os_err
+                    if not idempotent:
+                        break
+                except Exception as err:
+                    error = err
+                    break
+                if attempt < max_retries:
+                    if retry_after is not None and retry_after.isdigit():
+                        delay = int(retry_after)
+                    else:
+                        delay = backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+                    time.sleep(delay)
+            return BulkResult(item, None, error)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            return list(executor.map(perform, requests))
+
+    def submit_query(self, api_url, params=None, *, collection_key=None, page_size=100):
+        """
+        submit a query with $async=true and return an AsyncQuery handle without waiting for the result.
+        Several queries can be submitted first and waited on later, the server builds them concurrently.
+
+        api_url -- absolute or relative api resource url, without query string, e.g. contacts url
+        params -- dict of extra query parameters, e.g. $filter or $select
+        collection_key -- name of the list attribute holding the items, e.g. 'Contacts'
+        page_size -- number of items requested per call when streaming the result
+        """
+        params = dict(params or {}, **{'$async': 'true'})
+        separator = '&' if '?' in api_url else '?'
+        response = self.request(api_url + separator + urllib.parse.urlencode(params))
+        return AsyncQuery(self, response.ResultUrl, getattr(response, 'State', None),
+                          collection_key=collection_key, page_size=page_size)
+
     def _get_access_token(self):
-        expires_at = self._token.retrieved_at + datetime.timedelta(seconds=self._token.expires_in - 100)
-        if datetime.datetime.now() > expires_at:
-            self._refresh_auth_token()
+        token = self._token
+        if self._token_expired(token):
+            # single flight: one thread refreshes, the others wait on the lock and reuse its token
+            with self._token_lock:
+                if self._token is token:
+                    self._refresh_auth_token()
         return self._token.access_token
 
     def _refresh_auth_token(self):
-        if self.api_key is not None:
-            self.authenticate_with_apikey(scope=self._api_key_refresh_scope)
-        else:
-            data = {
-                "grant_type": "refresh_token",
-                "refresh_token": self._token.refresh_token
-            }
-            self.request_token(data, self.client_id + ':' + self.client_secret)
+        self.request_token(*self._refresh_grant(), refresh=True)
+
+    def _schedule_refresh(self):
+        if self._refresh_timer is not None:
+            self._refresh_timer.cancel()
+        # wake up refresh_lead before the token would be considered expired; a token already past that point
+        # is left to the next request, rescheduling it would refresh in a tight loop
+        delay = (self._token_expires_at() - self.refresh_lead - datetime.datetime.now()).total_seconds()
+        if delay <= 0:
+            self._refresh_timer = None
+            return
+        self._refresh_timer = threading.Timer(delay, self._background_refresh, args=(self._token,))
+        self._refresh_timer.daemon = True
+        self._refresh_timer.start()
+
+    def _background_refresh(self, token):
+        with self._token_lock:
+            if self._token is not token:
+                return
+            try:
+                self._refresh_auth_token()
+            except (OSError, APIException):
+                # the next request refreshes the token itself
+                pass
+
+    @staticmethod
+    def _stream_response(http_response, collection_key=None):
+        try:
+            for item in _JsonArrayStream(http_response).items(collection_key):
+                yield _wrap(item)
+            # drain whatever follows the array so the connection goes back to the pool
+            while http_response.read(_JsonArrayStream.chunk_size):
+                pass
+        finally:
+            http_response.close()
 
     @staticmethod
     def _parse_response(http_response):
-        decoded = json.loads(http_response.read().decode())
-        if isinstance(decoded, list):
-            result = []
-            for item in decoded:
-                result.append(APIObject(item))
-            return result
-        elif isinstance(decoded, dict):
-            return APIObject(decoded)
-        else:
+        return WildApricotClient._wrap_response(json.loads(http_response.read().decode()))
+
+
+def _write_json_atomic(filename, data):
+    """
+    write data as json to a temp file, private to the user (0600, it may hold bearer tokens), then rename it
+    over filename, so runs sharing the file never see it half written
+    """
+    descriptor, temp_name = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)),
+                                             prefix=os.path.basename(filename) + '.')
+    try:
+        with open(descriptor, 'w') as json_file:
+            json.dump(data, json_file)
+        os.replace(temp_name, filename)
+    except BaseException:
+        os.remove(temp_name)
+        raise
+
+
+class ResponseCache:
+    """
+    Opt-in cache of GET responses, see WildApricotClient(response_cache=...).
+    Responses are kept in an in-memory LRU and, if directory is given, on disk so they outlive the process.
+    Entries younger than the ttl of their endpoint are served without any call; older ones are revalidated
+    with If-None-Match/If-Modified-Since when the server sent an ETag/Last-Modified, and reused on 304.
+    Only urls matching one of ttls (or any url when default_ttl is set) are cached.
+
+    Example:
+        cache = ResponseCache('wa_cache', ttls={'/membergroups': 24 * 3600, '/events/': 300})
+        api = WildApricotClient(api_key=key, response_cache=cache)
+        ...
+        print(cache.stats())
+    """
+
+    def __init__(self, directory=None, maxsize=256, ttls=None, default_ttl=None):
+        """
+        directory -- optional directory for the on-disk store
+        maxsize -- number of responses kept in memory
+        ttls -- dict of url substring (case-insensitive) -> seconds a response stays fresh; the first match wins.
+                0 means always revalidate, so only the body of a 304 is saved
+        default_ttl -- seconds for urls not matching ttls, None not to cache them at all
+        """
+        self.directory = directory
+        self.maxsize = maxsize
+        self.ttls = dict(ttls or {})
+        self.default_ttl = default_ttl
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def ttl(self, url):
+        # resource urls are CamelCase (.../MemberGroups/), patterns match regardless of case
+        url = url.lower()
+        for pattern, seconds in self.ttls.items():
+            if pattern.lower() in url:
+                return seconds
+        return self.default_ttl
+
+    def count(self, outcome):
+        """count a request served from the cache: 'hits', 'misses' or 'revalidations'"""
+        with self._lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'revalidations': self.revalidations,
+                    'entries': len(self._entries)}
+
+    def get(self, url):
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is not None:
+                self._entries.move_to_end(url)
+                return entry
+        if self.directory is None:
+            return None
+        try:
+            with open(self._path(url)) as entry_file:
+                entry = json.load(entry_file)
+        except (OSError, ValueError):
             return None
+        self._remember(url, entry)
+        return entry
+
+    def put(self, url, body, etag=None, last_modified=None):
+        entry = {'url': url, 'stored_at': time.time(), 'etag': etag, 'last_modified': last_modified, 'body': body}
+        self._remember(url, entry)
+        if self.directory is not None:
+            with open(self._path(url), 'w') as entry_file:
+                json.dump(entry, entry_file)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        if self.directory is not None:
+            for filename in os.listdir(self.directory):
+                if filename.endswith('.json'):
+                    os.remove(os.path.join(self.directory, filename))
+
+    def _remember(self, url, entry):
+        with self._lock:
+            self._entries[url] = entry
+            self._entries.move_to_end(url)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def _path(self, url):
+        return os.path.join(self.directory, hashlib.sha256(url.encode()).hexdigest() + '.json')
+
+
+BulkResult = collections.namedtuple('BulkResult', ['request', 'result', 'error'])
+
+
+class _TokenBucket:
+    """Thread-safe token bucket allowing `rate` acquisitions per `per` seconds, with bursts of up to `rate`"""
+
+    def __init__(self, rate, per=60):
+        self.rate = rate
+        self.per = per
+        self._tokens = float(rate)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate / self.per)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) * self.per / self.rate
+            time.sleep(wait)
+
+
+class AsyncQuery:
+    """
+    Handle of a query submitted with $async=true, see WildApricotClient.submit_query.
+    The server builds the result in the background: check it with done(), block on it with wait(),
+    then iterate over the handle to stream the items page by page.
+    """
+
+    def __init__(self, client, result_url, state=None, *, collection_key=None, page_size=100):
+        self.client = client
+        self.result_url = result_url
+        self.state = state
+        self.collection_key = collection_key
+        self.page_size = page_size
+
+    def poll(self):
+        """ask the server once for the state of the result and return it"""
+        separator = '&' if '?' in self.result_url else '?'
+        response = self.client.request(self.result_url + separator + urllib.parse.urlencode({'$top': '1'}))
+        self.state = getattr(response, 'State', 'Complete')
+        if self.state == 'Failed':
+            raise APIException("Async query failed: " + str(response))
+        return self.state
+
+    def done(self):
+        """non-blocking check whether the result is ready"""
+        return self.state == 'Complete' or self.poll() == 'Complete'
+
+    def wait(self, timeout=None, initial_delay=0.5, max_delay=10, backoff=2):
+        """poll with exponential backoff until the result is ready; raise TimeoutError after timeout seconds"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        delay = initial_delay
+        while not self.done():
+            if deadline is not None and time.monotonic() + delay > deadline:
+                raise TimeoutError(f"Async query {self.result_url} is still {self.state} after {timeout}s")
+            time.sleep(delay)
+            delay = min(delay * backoff, max_delay)
+        return self
+
+    def __iter__(self):
+        self.wait()
+        return self.client.iter_collection(self.result_url, page_size=self.page_size,
+                                           collection_key=self.collection_key, query_result=True)
+
+
+class _ConnectionPool:
+    """
+    Thread-safe pool of persistent HTTP(S) connections keyed by (scheme, host, port).
+    Connections are handed out exclusively and returned once their response body has been read,
+    so consecutive calls to the same host reuse one TCP+TLS session instead of reconnecting.
+    """
+
+    def __init__(self, maxsize=4, timeout=60):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def urlopen(self, method, url, body=None, headers=None):
+        """
+        send request over a pooled connection and return a _PooledResponse.
+        Raises urllib.error.HTTPError for 4xx/5xx statuses, same as urllib.request.urlopen.
+        """
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+        headers = dict(headers or {})
+
+        connection, reused = self._acquire(key)
+        while True:
+            try:
+                connection.request(method, path, body=body, headers=headers)
+                response = connection.getresponse()
+                break
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                connection.close()
+                if not reused:
+                    raise
+                # the server dropped an idle keep-alive connection, retry once on a fresh one
+                connection, reused = self._connect(key), False
+            except BaseException:
+                connection.close()
+                raise
+
+        pooled = _PooledResponse(self, key, connection, response)
+        if response.status >= 400:
+            content = pooled.read()
+            raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, io.BytesIO(content))
+        return pooled
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def _acquire(self, key):
+        with self._lock:
+            connections = self._idle.get(key)
+            if connections:
+                return connections.pop(), True
+        return self._connect(key), False
+
+    def _connect(self, key):
+        scheme, host, port = key
+        if scheme == 'https':
+            return http.client.HTTPSConnection(host, port, timeout=self.timeout)
+        return http.client.HTTPConnection(host, port, timeout=self.timeout)
+
+    def _release(self, key, connection):
+        with self._lock:
+            connections = self._idle.setdefault(key, [])
+            if len(connections) < self.maxsize:
+                connections.append(connection)
+                return
+        connection.close()
+
+
+class _PooledResponse:
+    """File-like wrapper of http.client.HTTPResponse that gives the connection back to the pool once drained"""
+
+    def __init__(self, pool, key, connection, response):
+        self._pool = pool
+        self._key = key
+        self._connection = connection
+        self._response = response
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.headers
+
+    def getheader(self, name, default=None):
+        return self._response.getheader(name, default)
+
+    def read(self, amt=None):
+        if self._connection is None:
+            return b''
+        try:
+            data = self._response.read(amt)
+        except BaseException:
+            self.close()
+            raise
+        if amt is None or not data or self._response.isclosed():
+            self._finish()
+        return data
+
+    def close(self):
+        """discard the connection if the body was not read to the end, it cannot be reused"""
+        if self._connection is not None:
+            self._response.close()
+            self._connection.close()
+            self._connection = None
+
+    def _finish(self):
+        connection, self._connection = self._connection, None
+        if self._response.will_close:
+            connection.close()
+        else:
+            self._pool._release(self._key, connection)
+
+
+class _JsonArrayStream:
+    """
+    Incremental decoder for the items of one json array read from a binary stream: either the top-level array,
+    or the array stored under a key of the top-level object. Only the current chunk and item are kept in memory.
+    """
+    chunk_size = 64 * 1024
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._text = codecs.getincrementaldecoder('utf-8')()
+        self._decoder = json.JSONDecoder()
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+
+    def items(self, collection_key=None):
+        if collection_key is None:
+            self._expect('[')
+        elif not self._seek_key(collection_key):
+            return
+        else:
+            self._expect('[')
+        if self._peek() == ']':
+            self._pos += 1
+            return
+        while True:
+            yield self._value()
+            char = self._next()
+            if char == ']':
+                return
+            if char != ',':
+                raise ValueError(f"Expected ',' or ']' in json array, got {char!r}")
+
+    def _seek_key(self, collection_key):
+        """consume the top-level object up to the array of collection_key; False if the key is missing"""
+        self._expect('{')
+        if self._peek() == '}':
+            return False
+        while True:
+            key = self._value()
+            self._expect(':')
+            if key == collection_key:
+                return True
+            self._value()
+            char = self._next()
+            if char == '}':
+                return False
+            if char != ',':
+                raise ValueError(f"Expected ',' or '}}' in json object, got {char!r}")
+
+    def _fill(self):
+        if self._eof:
+            return False
+        data = self._stream.read(self.chunk_size)
+        self._eof = not data
+        self._buffer = self._buffer[self._pos:] + self._text.decode(data, final=self._eof)
+        self._pos = 0
+        return not self._eof
+
+    def _skip_whitespace(self):
+        while True:
+            while self._pos < len(self._buffer) and self._buffer[self._pos] in ' \t\r\n':
+                self._pos += 1
+            if self._pos < len(self._buffer) or not self._fill():
+                return
+
+    def _peek(self):
+        self._skip_whitespace()
+        if self._pos >= len(self._buffer):
+            raise ValueError("Unexpected end of json stream")
+        return self._buffer[self._pos]
+
+    def _next(self):
+        char = self._peek()
+        self._pos += 1
+        return char
+
+    def _expect(self, expected):
+        char = self._next()
+        if char != expected:
+            raise ValueError(f"Expected {expected!r} in json stream, got {char!r}")
+
+    def _value(self):
+        self._skip_whitespace()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                if self._fill():
+                    continue
+                raise
+            # a number at the very end of the buffer may continue in the next chunk
+            if end == len(self._buffer) and self._fill():
+                continue
+            self._pos = end
+            return value
 
 
 class APIException(Exception):
@@ -156,36 +956,75 @@ class APIException(Exception):
 
 
 class APIObject:
-    """Represent any api call input or output object"""
+    """
+    Represent any api call input or output object.
+    Nested dicts and lists are wrapped lazily on first attribute access, and FieldValues are indexed
+    by FieldName the first time the object is indexed, so parsing big responses stays cheap.
+    """
+    __slots__ = ('_state', '_resolved', '_fields')
 
     def __init__(self, state):
-        self.__dict__ = state
-        for key, value in vars(self).items():
-            if isinstance(value, dict):
-                self.__dict__[key] = APIObject(value)
-            elif isinstance(value, list):
-                new_list = []
-                for list_item in value:
-                    if isinstance(list_item, dict):
-                        new_list.append(APIObject(list_item))
-                    else:
-                        new_list.append(list_item)
-                self.__dict__[key] = new_list
+        self._state = state
+        self._resolved = set()
+        self._fields = None
+
+    def __getattr__(self, name):
+        # only called when name is not a slot; guard against lookups before __init__ ran, e.g. while unpickling
+        if name in APIObject.__slots__:
+            raise AttributeError(name)
+        state = self._state
+        try:
+            value = state[name]
+        except KeyError:
+            raise AttributeError(name) from None
+        if name not in self._resolved:
+            value = state[name] = _wrap(value)
+            self._resolved.add(name)
+        return value
+
+    def __setattr__(self, name, value):
+        if name in APIObject.__slots__:
+            object.__setattr__(self, name, value)
+            return
+        self._state[name] = value
+        self._resolved.discard(name)
+        if name == 'FieldValues':
+            self._fields = None
+
+    def __delattr__(self, name):
+        try:
+            del self._state[name]
+        except KeyError:
+            raise AttributeError(name) from None
+        self._resolved.discard(name)
+        if name == 'FieldValues':
+            self._fields = None
+
+    def __dir__(self):
+        return list(super().__dir__()) + list(self._state)
 
     def __getitem__(self, key):
-        if not hasattr(self, 'FieldValues'):
-            message = "This object does not have FieldValues attribute and cannot be indexed; try to access it as an attribute"
-            raise ValueError(message)
-        for field in self.FieldValues:
-            if field.FieldName == key:
-                return field.Value
-        raise KeyError(key)
+        if self._fields is None:
+            if not hasattr(self, 'FieldValues'):
+                message = "This object does not have FieldValues attribute and cannot be indexed; try to access it as an attribute"
+                raise ValueError(message)
+            self._fields = {}
+            for field in self.FieldValues:
+                self._fields.setdefault(field.FieldName, field)
+        try:
+            return self._fields[key].Value
+        except KeyError:
+            raise KeyError(key) from None
 
     def _jsons_massive_dump(self):
-        return json.dumps(self.__dict__, default=lambda obj: obj.isoformat() if isinstance(obj, datetime.datetime) else obj.__dict__, indent=4)
+        return json.dumps(self._state, default=lambda obj: obj.isoformat() if isinstance(obj, datetime.datetime) else obj._state, indent=4)
 
     def _json_cleans(self):
-        return json.loads(self._jsons_massive_dump())
+        return self.to_plain()
+
+    def to_plain(self):
+        """return a copy made of plain dicts, lists and scalars (datetimes as isoformat), e.g. for other db clients"""
+        return _to_plain(self._state)
 
     def __str__(self):
         return 'JSON: ' + self._jsons_massive_dump()
@@ -194,9 +1033,45 @@ class APIObject:
         og = super().__repr__()
         return og + ': JSON: ' + self._jsons_massive_dump()
 
+
+def _to_plain(value):
+    if isinstance(value, APIObject):
+        value = value._state
+    if isinstance(value, dict):
+        return {key: _to_plain(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_plain(item) for item in value]
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return value
+
+
+def _wrap(value):
+    """wrap one level of raw json value into APIObjects; deeper levels are wrapped when accessed"""
+    if isinstance(value, dict):
+        return APIObject(value)
+    if isinstance(value, list):
+        return [APIObject(item) if isinstance(item, dict) else item for item in value]
+    return value
+
 class _APIObjectEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, APIObject):
-            return obj.__dict__
+            return obj._state
+        if isinstance(obj, (datetime.datetime, datetime.date)):
+            return obj.isoformat()
         # Let the base class default method raise the TypeError
         return json.JSONEncoder.default(self, obj)
+
+
+def _orjson_default(obj):
+    if isinstance(obj, APIObject):
+        return obj._state
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def _json_dumps(obj):
+    """serialize to utf-8 json bytes, with orjson when it is installed"""
+    if orjson is not None:
+        return orjson.dumps(obj, default=_orjson_default)
+    return json.dumps(obj, cls=_APIObjectEncoder).encode()
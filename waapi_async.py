@@ -0,0 +1,136 @@
+"""
+asyncio flavour of waapi.WildApricotClient, for bots that serve several members at once.
+
+Example:
+    import asyncio
+    from waapi_async import AsyncWildApricotClient
+
+    async def main():
+        async with AsyncWildApricotClient(api_key=wild_apricot_api_key) as api:
+            await api.authenticate_with_apikey()
+            accounts = await api.request("/v2/accounts")
+            async for contact in api.iter_collection(contacts_url, {'$filter': 'member eq true'}):
+                print(contact.DisplayName)
+
+    asyncio.run(main())
+"""
+
+import asyncio
+import json
+
+import aiohttp # pip install aiohttp
+
+from waapi import _BaseClient, APIException
+
+
+class AsyncWildApricotClient(_BaseClient):
+    """Wild apricot API client with the same surface as waapi.WildApricotClient, every call is a coroutine."""
+
+    def __init__(self, client_id=None, client_secret=None, *, api_key=None, pool_size=4, timeout=60):
+        """
+        client_id -- client id from account settings
+        client_secret -- client secret from account settings
+        api_key -- secret api key from account settings (alternative for servers)
+        pool_size -- max number of simultaneous connections per host
+        timeout -- total timeout in seconds for every api call
+        """
+        super().__init__(client_id, client_secret, api_key=api_key)
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self._session = None
+        self._refresh_lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _get_session(self):
+        # created lazily so the session belongs to the running event loop
+        if self._session is None:
+            connector = aiohttp.TCPConnector(limit_per_host=self.pool_size)
+            self._session = aiohttp.ClientSession(connector=connector,
+                                                  timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self._session
+
+    async def request_token(self, data, authorization):
+        encoded_data, headers = self._token_request(data, authorization)
+        async with self._get_session().post(self.auth_endpoint, data=encoded_data, headers=headers) as response:
+            self._set_token(await self._parse_response(response))
+
+    async def authenticate_with_apikey(self, scope='auto'):
+        """perform authentication by api key and store result for request method
+        scope -- optional scope of authentication request. If `auto` full list of API scopes will be used.
+        """
+        await self.request_token(*self._apikey_grant(scope))
+        self._api_key_refresh_scope = scope
+
+    async def authenticate_with_contact_credentials(self, username, password, scope='auto'):
+        """perform authentication by contact credentials and store result for request method
+
+        username -- typically a contact email
+        password -- contact password
+        scope -- optional scope of authentication request. If `auto` full list of API scopes will be used.
+        """
+        await self.request_token(*self._contact_grant(username, password, scope))
+
+    async def request(self, api_url, post_payload=None, method=None):
+        """
+        perform api request and return result as an instance of APIObject or list of APIObjects
+
+        api_url -- absolute or relative api resource url
+        post_payload -- any json serializable object to send to API
+        method -- HTTP method of api request. Default: GET if post_payload is None else POST
+        """
+        self._check_authenticated()
+        api_url, method, data = self._api_request(api_url, post_payload, method)
+        headers = self._api_headers(await self._get_access_token())
+
+        async with self._get_session().request(method, api_url, data=data, headers=headers) as response:
+            return await self._parse_response(response)
+
+    async def iter_collection(self, api_url, params=None, page_size=100, *, collection_key=None):
+        """
+        page through a collection with $skip/$top and yield its items one at a time as APIObjects
+
+        api_url -- absolute or relative api resource url, without query string
+        params -- dict of extra query parameters, e.g. $filter or $select
+        page_size -- number of items requested per call ($top)
+        collection_key -- name of the list attribute holding the items, e.g. 'Contacts'.
+                          Default: the response itself if it is a list, else its first list attribute
+        """
+        params = self._collection_params(params)
+        skip = 0
+        while True:
+            response = await self.request(self._page_url(api_url, params, skip, page_size))
+            items = self._collection_items(response, collection_key)
+            for item in items:
+                yield item
+            if len(items) < page_size:
+                return
+            skip += page_size
+
+    async def _get_access_token(self):
+        if self._token_expired():
+            # single flight: the first coroutine refreshes, the others wait and then reuse its token
+            async with self._refresh_lock:
+                if self._token_expired():
+                    await self._refresh_auth_token()
+        return self._token.access_token
+
+    async def _refresh_auth_token(self):
+        await self.request_token(*self._refresh_grant())
+
+    @staticmethod
+    async def _parse_response(response):
+        content = await response.read()
+        if response.status == 400:
+            raise APIException(content)
+        response.raise_for_status()
+        return _BaseClient._wrap_response(json.loads(content.decode()))